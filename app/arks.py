@@ -0,0 +1,80 @@
+"""
+ARK identifier pool: identifiers are minted in blocks, checked against existing rows once per block
+and handed out from memory, the primary key of the stored row remains the final uniqueness check
+"""
+import threading
+import configparser
+from collections import deque
+
+from noid.pynoid import mint
+from sqlalchemy import select
+
+from app.config import ARK_BATCH, ARK_DATASETS, ARK_MULTIMEDIA
+from app import model_text
+from app.database import engine
+
+config = configparser.ConfigParser()
+config.read('./config.ini')
+
+ARK_TEMPLATES = {
+    ARK_BATCH: 'bat.eeddeedek',
+    ARK_DATASETS: 'dts.eeddeedek',
+    ARK_MULTIMEDIA: 'eeddeede',
+}
+
+# primary key an ark type is stored under, dataset arks of exports are not stored
+ARK_COLUMNS = {
+    ARK_BATCH: model_text.Batch.ark_id,
+    ARK_MULTIMEDIA: model_text.Multimeida.ark_id,
+}
+
+
+# one new ark: ['ark:', naa, id]
+def mint_ark(ark_type):
+    template = ARK_TEMPLATES.get(ark_type, ARK_TEMPLATES[ARK_BATCH])
+    return mint(template=template, scheme='ark:/', naa='89609').split("/")
+
+
+class ArkPool:
+    """
+    reserves block_size identifiers per ark type at a time, a block holds no identifier twice and none
+    that was used by a stored row when the block was reserved, so taking an identifier is usually a pop
+    from memory, the pool runs empty once per block and take then queries the database: call it from
+    a worker thread(run_db), not from the event loop
+
+    identifiers in the pools of other processes or taken but not committed yet are not known to the check,
+    a collision with them(unlikely for random identifiers) fails on the primary key of the insert
+    """
+
+    def __init__(self, block_size=1000):
+        self.block_size = block_size
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def take(self, ark_type):
+        with self._lock:
+            free = self._free.setdefault(ark_type, deque())
+            if not free:
+                free.extend(self._reserve(ark_type))
+            return free.popleft()
+
+    # a block of new arks, minted at random and filtered against the table of the ark type
+    def _reserve(self, ark_type):
+        block = {}
+        while len(block) < self.block_size:
+            ark_obj = mint_ark(ark_type)
+            block[ark_obj[2]] = ark_obj
+        column = ARK_COLUMNS.get(ark_type)
+        if column is not None:
+            with engine.connect() as connection:
+                used = connection.execute(select(column).where(column.in_(list(block)))).scalars().all()
+            for ark_id in used:
+                del block[ark_id]
+        return list(block.values())
+
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+
+
+ark_pool = ArkPool(block_size=config.getint('ark-pool', 'block_size', fallback=1000))
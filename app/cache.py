@@ -0,0 +1,195 @@
+"""
+in-process caches
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+import configparser
+from collections import OrderedDict
+
+config = configparser.ConfigParser()
+config.read('./config.ini')
+
+
+class TTLCache:
+    """
+    thread-safe mapping with a time to live per entry and least recently used eviction
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# api key -> resolved person({'api_key', 'people_id', 'name'}) or {'detail': ...} for unknown keys
+auth_cache = TTLCache(maxsize=config.getint('auth-cache', 'maxsize', fallback=1024),
+                      ttl=config.getint('auth-cache', 'ttl', fallback=300))
+
+
+# canonical hash of json-like parts, dict keys are sorted so equal parameters give equal keys
+def cache_key(*parts):
+    canonical = json.dumps(parts, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class DiskCache:
+    """
+    files on disk keyed by a content hash(root/<key>/<filename>) with a total size budget,
+    the least recently used entries are removed first, entries read or written in the last hold_seconds are kept
+    so a returned path is still there when the response is sent,
+    entries and sizes are indexed in memory when the cache is created, entries stored by other processes
+    are picked up on their first read
+    """
+
+    def __init__(self, root, max_bytes, hold_seconds=60):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hold_seconds = hold_seconds
+        self._lock = threading.Lock()
+        # key: [filename, size, last access(monotonic)], least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        os.makedirs(self.root, exist_ok=True)
+        for _, key, filename, size in sorted(filter(None, map(self._scan, os.listdir(self.root)))):
+            self._entries[key] = [filename, size, 0.0]
+            self._size += size
+
+    # (modification time, key, filename, size) of an entry on disk or None
+    def _scan(self, key):
+        entry = os.path.join(self.root, key)
+        try:
+            filenames = [name for name in os.listdir(entry) if not name.startswith('.')]
+            if not filenames:
+                return None
+            return os.path.getmtime(entry), key, filenames[0], os.path.getsize(os.path.join(entry, filenames[0]))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def _add(self, key, filename, size):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= previous[1]
+        self._entries[key] = [filename, size, time.monotonic()]
+        self._size += size
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    # path of the cached file or None, a hit marks the entry as recently used
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            scanned = self._scan(key)
+            if scanned is None:
+                return None
+            with self._lock:
+                self._add(key, scanned[2], scanned[3])
+            self.evict(keep=key)
+            return os.path.join(self.root, key, scanned[2])
+        path = os.path.join(self.root, key, entry[0])
+        with self._lock:
+            # removed by another process
+            if not os.path.exists(path):
+                self._remove(key)
+                return None
+            if key in self._entries:
+                entry[2] = time.monotonic()
+                self._entries.move_to_end(key)
+        return path
+
+    # pass chunks through while writing them to the cache, the entry only appears once all chunks were written
+    def store(self, key, filename, chunks):
+        entry = os.path.join(self.root, key)
+        os.makedirs(entry, exist_ok=True)
+        temp_path = os.path.join(entry, '.' + uuid.uuid4().hex + '.tmp')
+        completed = False
+        size = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            with self._lock:
+                os.replace(temp_path, os.path.join(entry, filename))
+                # the same entry built again under another file name
+                previous = self._entries.get(key)
+                if previous is not None and previous[0] != filename:
+                    try:
+                        os.remove(os.path.join(entry, previous[0]))
+                    except FileNotFoundError:
+                        pass
+                self._add(key, filename, size)
+            completed = True
+        finally:
+            if not completed and os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.evict(keep=key)
+
+    def put(self, key, filename, data):
+        for _ in self.store(key, filename, [data]):
+            pass
+        return self.get(key)
+
+    # remove least recently used entries until the cache fits in max_bytes
+    def evict(self, keep=None):
+        now = time.monotonic()
+        with self._lock:
+            size = self._size
+            evicted = []
+            for key, (filename, entry_size, last_access) in self._entries.items():
+                if size <= self.max_bytes:
+                    break
+                if key == keep or now - last_access < self.hold_seconds:
+                    continue
+                evicted.append(key)
+                size -= entry_size
+            for key in evicted:
+                self._remove(key)
+                shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+
+
+# built export archives, keyed by the export parameters and the data watermark
+export_cache = DiskCache(root=config.get('export-cache', 'path', fallback='./export_cache'),
+                         max_bytes=config.getint('export-cache', 'max_bytes', fallback=10 * 1024 ** 3))
+
+
+# generated thumbnails and previews, keyed by ark id, derivative and size
+derivative_cache = DiskCache(root=config.get('derivatives', 'path', fallback='./derivative_cache'),
+                             max_bytes=config.getint('derivatives', 'max_bytes', fallback=1024 ** 3))
@@ -0,0 +1,182 @@
+"""
+response compression: an ASGI middleware negotiating zstd/br/gzip from Accept-Encoding,
+streamed bodies are compressed chunk by chunk and flushed so nothing is held back
+"""
+import zlib
+import configparser
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - zstandard is optional
+    zstandard = None
+
+config = configparser.ConfigParser()
+config.read('./config.ini')
+
+# already compressed payloads
+SKIP_CONTENT_TYPES = ('application/zip', 'application/x-zip-compressed', 'application/gzip', 'application/zstd',
+                      'application/x-parquet', 'image/', 'video/', 'audio/')
+
+
+class GzipEncoder:
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliEncoder:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class ZstdEncoder:
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+# content-coding -> (encoder class, level), only codings whose library is installed
+ENCODERS = {'gzip': (GzipEncoder, config.getint('compression', 'gzip_level', fallback=6))}
+if brotli is not None:
+    ENCODERS['br'] = (BrotliEncoder, config.getint('compression', 'brotli_quality', fallback=4))
+if zstandard is not None:
+    ENCODERS['zstd'] = (ZstdEncoder, config.getint('compression', 'zstd_level', fallback=3))
+
+
+# content-codings accepted by the client: {coding: q}
+def accepted_encodings(accept_encoding):
+    accepted = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            accepted[coding.lower()] = q
+    return accepted
+
+
+# best coding in server preference order that the client accepts, None for identity
+def negotiate(accept_encoding, preference):
+    accepted = accepted_encodings(accept_encoding)
+    for coding in preference:
+        if coding in ENCODERS and accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+class CompressionMiddleware:
+    """
+    compresses responses of at least minimum_size bytes, streamed responses are always compressed as
+    their size is unknown, responses that are already encoded, ranges and compressed media types are left alone
+    """
+
+    def __init__(self, app, minimum_size=500, preference=('zstd', 'br', 'gzip')):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.preference = preference
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        coding = negotiate(Headers(scope=scope).get('accept-encoding', ''), self.preference)
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = CompressionResponder(send, coding, self.minimum_size)
+        await self.app(scope, receive, responder.send)
+
+
+class CompressionResponder:
+    def __init__(self, send, coding, minimum_size):
+        self._send = send
+        self.coding = coding
+        self.minimum_size = minimum_size
+        self.start_message = None
+        self.encoder = None
+        self.passthrough = False
+
+    def compressible(self, headers):
+        content_type = headers.get('content-type', '')
+        return 'content-encoding' not in headers and 'content-range' not in headers \
+            and not content_type.startswith(SKIP_CONTENT_TYPES)
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            headers = MutableHeaders(raw=message['headers'])
+            if message['status'] in (204, 206, 304) or not self.compressible(headers):
+                self.passthrough = True
+                await self._send(message)
+                return
+            headers.add_vary_header('Accept-Encoding')
+            # held back until the first body message tells whether the body is streamed
+            self.start_message = message
+            return
+        if message['type'] != 'http.response.body' or self.passthrough:
+            await self._send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if self.start_message is not None:
+            start_message, self.start_message = self.start_message, None
+            if not more_body and len(body) < self.minimum_size:
+                self.passthrough = True
+                await self._send(start_message)
+                await self._send(message)
+                return
+            encoder_class, level = ENCODERS[self.coding]
+            self.encoder = encoder_class(level)
+            headers = MutableHeaders(raw=start_message['headers'])
+            headers['Content-Encoding'] = self.coding
+            if more_body:
+                del headers['Content-Length']
+            else:
+                body = self.encoder.compress(body) + self.encoder.finish()
+                headers['Content-Length'] = str(len(body))
+                await self._send(start_message)
+                await self._send({'type': 'http.response.body', 'body': body})
+                return
+            await self._send(start_message)
+
+        body = self.encoder.compress(body) if body else b''
+        if not more_body:
+            body += self.encoder.finish()
+        await self._send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+
+def compression_options():
+    preference = [coding.strip() for coding in
+                  config.get('compression', 'encodings', fallback='zstd,br,gzip').split(',') if coding.strip()]
+    return {
+        'minimum_size': config.getint('compression', 'minimum_size', fallback=500),
+        'preference': tuple(preference),
+    }
@@ -6,3 +6,8 @@ ZIPFILES_PATH = "C:\\work\\hdr\\filelist_demo\\zipfile_demo-20221025T154329Z-001
 ARK_BATCH = "batch"
 ARK_DATASETS = "datasets"
 ARK_MULTIMEDIA = "multimedia"
+# uploaded multimedia files are stored under MULTIMEDIA_PATH/<batch ark id>/ and published under MULTIMEDIA_URL
+MULTIMEDIA_PATH = "c:\\"
+MULTIMEDIA_URL = "https://fishair.org/hdr-share/ftp/ark/89609/"
+# public address of this api, derivative urls in responses are relative when empty
+API_URL = ""
@@ -2,20 +2,37 @@
 CURD parts
 !!!This section of code needs to be refactored and remove redundant parts.
 """
+import asyncio
 import os
 import uuid
+import configparser
+import logging
+from datetime import timedelta, timezone
 
 import aiofiles
 from fastapi import UploadFile
-from sqlalchemy import or_
+from sqlalchemy import and_, exc, func, insert, literal, or_, select, union
 from sqlalchemy.orm import Session
-from sqlalchemy.orm import joinedload
-from app.utils import minter, create_api_key
+from sqlalchemy.orm import aliased, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from app.utils import minter, create_api_key, file_format, store_image
+from app.cache import auth_cache, cache_key, derivative_cache
+from app.database import run_db
+from app.metrics import span, span_iter
+from app.imaging import image_analyzer, invalid_image_reason, DERIVATIVE_SIZES, INVALID_IMAGE_ERRORS, \
+    ImageAnalysisError
 import app.config as config
-from PIL import Image
 from pathlib import Path
 
-from . import model_text
+from . import model_text, schemas
+
+logger = logging.getLogger(__name__)
+
+config_ini = configparser.ConfigParser()
+config_ini.read('./config.ini')
+
+# seconds the watermark of a delta export is taken before the database time
+delta_lag_seconds = config_ini.getint('delta-export', 'lag_seconds', fallback=300)
 
 
 def get_iqs(db: Session, skip: int = 0, limit: int = 100):
@@ -40,6 +57,8 @@ def create_people(db: Session, first_name, last_name,
     db.add(user)
     db.commit()
     db.refresh(user)
+    # drop a cached "not valid" result for the new key
+    auth_cache.invalidate(api_key)
     return {"api_key": api_key}
 
 
@@ -51,25 +70,46 @@ def get_people(db: Session, email):
     return {"email": user.email, "api_key": api_key}
 
 
+# resolve the person of an api key, results(also invalid keys) are cached in auth_cache
 def get_people_by_apikey(db: Session, api_key):
+    if api_key is None:
+        return {'detail': 'API Key not valid'}
+    cached = auth_cache.get(api_key)
+    if cached is not None:
+        return cached
     user = db.query(model_text.Person).filter(model_text.Person.api_key == api_key).first()
     if not user:
-        return {'detail': 'API Key not valid'}
-    api_key = user.api_key
-    return {"api_key": api_key}
+        result = {'detail': 'API Key not valid'}
+    else:
+        result = {"api_key": user.api_key, "people_id": user.people_id,
+                  "name": str(user.first_name) + ' ' + str(user.last_name)}
+    auth_cache.set(api_key, result)
+    return result
+
+
+# add and commit new rows(blocking, use run_db from async code), returns the error message on failure
+def commit_new(db: Session, *rows):
+    try:
+        for row in rows:
+            db.add(row)
+        db.commit()
+        for row in rows:
+            db.refresh(row)
+    except Exception as error:
+        db.rollback()
+        return str(error)
+    return None
 
 
 # Batches
-async def create_batch(db: Session, institution, pipeline,
+async def create_batch(db: Session, institution, pipeline, batchName,
                        comment, codeRepo, url,
-                       dataset, citation, supplement_file, api_key):
+                       dataset, citation, supplement_file, user):
     try:
-        user = db.query(model_text.Person).filter(model_text.Person.api_key == api_key).first()
-        if not user:
-            return {'detail': 'API Key not valid'}
-        creator_id = user.people_id
-        creator_name = user.first_name + ' ' + user.last_name
-        ark_id_obj = minter(config.ARK_BATCH)
+        creator_id = user['people_id']
+        creator_name = user['name']
+        # a block of new arks is checked against the database when the pool runs empty
+        ark_id_obj = await run_db(minter, config.ARK_BATCH)
         path = Path("/www/hdr/hdr-share/ftp/ark/89609/" + ark_id_obj[2] + "/supplement_file/")
         if not os.path.exists(path):
             os.makedirs(path)
@@ -77,12 +117,13 @@ async def create_batch(db: Session, institution, pipeline,
             file_name = Path(path, supplement_file.filename)
             if not os.path.exists(file_name):
                 async with aiofiles.open(file_name, 'wb') as f:
-                    await f.write(supplement_file.file.read())
+                    await f.write(await supplement_file.read())
 
     except Exception as error:
         return str("upload supplement failed:" + str(error))
 
     new_batch = model_text.Batch(ark_id=ark_id_obj[2])
+    new_batch.batch_name = batchName
     new_batch.institution_code = institution
     new_batch.pipeline = pipeline
     new_batch.creator = creator_name
@@ -96,210 +137,638 @@ async def create_batch(db: Session, institution, pipeline,
     if supplement_file is not None:
         new_batch.supplement_path = "https://fishair.org/hdr-share/ftp/ark/89609/" + ark_id_obj[
             2] + "/supplement_file/" + supplement_file.filename
-    try:
-        db.add(new_batch)
-        db.commit()
-        db.refresh(new_batch)
-        return new_batch
-    except Exception as error:
-        db.rollback()
-        return str(error)
+    error = await run_db(commit_new, db, new_batch)
+    if error is not None:
+        return error
+    return new_batch
 
 
-# return batchlist by user apikey
-def get_batch_list(db: Session, api_key):
-    user = db.query(model_text.Person).filter(model_text.Person.api_key == api_key).first()
+# return batchlist by user(resolved by get_people_by_apikey)
+def get_batch_list(db: Session, user):
     if user is None:
         return "Invalid API key or User doesn't exist."
-    batch_list = db.query(model_text.Batch).filter(model_text.Batch.creator_user_id == user.people_id).all()
+    batch_list = db.query(model_text.Batch).filter(model_text.Batch.creator_user_id == user['people_id']).all()
     return batch_list
 
 
+# storage location of a multimedia file
+def multimedia_file_path(batch_ark_id, ark_id, format):
+    return Path(config.MULTIMEDIA_PATH + batch_ark_id, ark_id + '.' + format)
+
+
+# column values of a new multimedia and its extended metadata
+def new_multimedia_rows(ark_id, batch, filename, width, height, size, parent_ark_id=None, image_license=None,
+                        image_source=None, image_institution_code=None, scientific_name=None, genus=None,
+                        family=None, dataset=None, resolution=None, content_hash=None):
+    format = file_format(filename)
+    multimedia_row = {
+        "ark_id": ark_id,
+        "parent_ark_id": parent_ark_id,
+        "batch_ark_id": batch.ark_id,
+        "batch_id": batch.batch_name,
+        "filename_as_delivered": filename,
+        "format": format,
+        "path": config.MULTIMEDIA_URL + batch.ark_id + "/" + ark_id + "." + format,
+        "license": image_license,
+        "source": image_source,
+        "owner_institution_code": image_institution_code,
+        "scientific_name": scientific_name,
+        "genus": genus,
+        "family": family,
+        "dataset": dataset,
+        "content_hash": content_hash,
+    }
+    extended_row = {
+        "ext_image_metadata_id": str(uuid.uuid4()),
+        "ark_id": ark_id,
+        "license": 'CC BY-NC',
+        "publisher": 'Fish-Air',
+        "owner_institution_code": 'TUBRI',
+        "width": width,
+        "height": height,
+        "size": size,
+        "resolution": resolution,
+    }
+    return multimedia_row, extended_row
+
+
+# analyse a stored image on the image analysis processes, an image that can not be decoded is removed from
+# storage and its error message returned(the reason only, the full error is logged), server side
+# failures(ImageAnalysisError) are raised
+async def analyze_stored_image(file_name):
+    try:
+        return await image_analyzer.analyze(file_name)
+    except INVALID_IMAGE_ERRORS as error:
+        logger.warning('invalid image %s: %r', file_name, error)
+        os.remove(file_name)
+        return 'Uploaded file is not a valid image: ' + invalid_image_reason(error)
+
+
+# multimedia already stored with this content, None for new content
+def get_multimedia_by_hash(db: Session, content_hash):
+    return db.query(model_text.Multimeida).filter(model_text.Multimeida.content_hash == content_hash).first()
+
+
+# ark ids of already stored contents: {content_hash: ark_id}
+def get_multimedia_arks_by_hash(db: Session, content_hashes):
+    if len(content_hashes) == 0:
+        return {}
+    rows = db.query(model_text.Multimeida.content_hash, model_text.Multimeida.ark_id) \
+        .filter(model_text.Multimeida.content_hash.in_(set(content_hashes))).all()
+    return {row.content_hash: row.ark_id for row in rows}
+
+
 # new multimedia
+# returns (multimedia, analysis), analysis is None when the same content was stored before and the existing
+# multimedia is returned instead, no second copy is kept
 async def create_multimedia(db: Session, file: UploadFile, batch_ark_id, prarent_ark_id, image_license, image_source,
                             image_institution_code,
                             scientific_name, genus, family, dataset):
     # check if batch arkid exists
-    matched_batch = db.query(model_text.Batch).filter(model_text.Batch.ark_id == batch_ark_id).all()
+    matched_batch = await run_db(db.query(model_text.Batch).filter(model_text.Batch.ark_id == batch_ark_id).all)
     if len(matched_batch) == 0:
         return "Sorry, there is no matched batch ARK ID."
     try:
-        # get information from upload image
-
-        # open image from UploadFile
-        image_content = file.file
-        image = Image.open(image_content)
-        # get image width and height
-        width, height = image.size
-        # turn the file pointer from the end of the file to the start of the file
-        file.file.seek(0)
-
         # insert media
-        multimedia_ark_id_obj = minter(config.ARK_MULTIMEDIA)
+        multimedia_ark_id_obj = await run_db(minter, config.ARK_MULTIMEDIA)
 
-        path = Path("c:\\" + batch_ark_id)
-        if not os.path.exists(path):
-            os.makedirs(path)
-        file_name = Path(path, multimedia_ark_id_obj[2] + '.' + file.filename.split(".")[1])
-        if not os.path.exists(file_name):
-            async with aiofiles.open(file_name, 'wb') as f:
-                await f.write(file.file.read())
+        file_name = multimedia_file_path(batch_ark_id, multimedia_ark_id_obj[2], file_format(file.filename))
+        # copy the upload to storage in one pass, size and dimensions are collected on the way
+        file.file.seek(0)
+        stored = await run_db(store_image, file.file, file.filename, file_name)
+        if isinstance(stored, str):
+            return stored
+        existing = await run_db(get_multimedia_by_hash, db, stored['content_hash'])
+        if existing is not None:
+            os.remove(file_name)
+            return existing, None
+        analysis = await analyze_stored_image(file_name)
+    except ImageAnalysisError:
+        os.remove(file_name)
+        raise
     except Exception as error:
         return str(error)
-    new_multimedia = model_text.Multimeida(ark_id=multimedia_ark_id_obj[2], parent_ark_id=prarent_ark_id)
-    new_multimedia.parent_ark_id = prarent_ark_id
-    new_multimedia.batch_ark_id = batch_ark_id
-    new_multimedia.batch_id = matched_batch[0].batch_name
-    new_multimedia.filename_as_delivered = file.filename
-    new_multimedia.format = file.filename.split(".")[1]
-    new_multimedia.path = "https://fishair.org/hdr-share/ftp/ark/89609/" + batch_ark_id + "/" + multimedia_ark_id_obj[
-        2] + "." + new_multimedia.format
-
-    new_multimedia.license = image_license
-    new_multimedia.source = image_source
-    new_multimedia.owner_institution_code = image_institution_code
-
-    new_multimedia.scientific_name = scientific_name
-    new_multimedia.genus = genus
-    new_multimedia.family = family
-    new_multimedia.dataset = dataset
-
-    new_mul_extendMetadata = model_text.ExtendedImageMetadatum(ark_id=new_multimedia.ark_id,
-                                                               ext_image_metadata_id=str(uuid.uuid4()))
-    new_mul_extendMetadata.license = 'CC BY-NC'
-    new_mul_extendMetadata.publisher = 'Fish-Air'
-    new_mul_extendMetadata.owner_institution_code = 'TUBRI'
-    new_mul_extendMetadata.width = width
-    new_mul_extendMetadata.height = height
-    # turn the file pointer from the end of the file to the start of the file
-    file.file.seek(0)
-    new_mul_extendMetadata.size = len(file.file.read())
+    if isinstance(analysis, str):
+        return analysis
+    multimedia_row, extended_row = new_multimedia_rows(
+        multimedia_ark_id_obj[2], matched_batch[0], file.filename, analysis['width'], analysis['height'],
+        stored['size'], parent_ark_id=prarent_ark_id, image_license=image_license, image_source=image_source,
+        image_institution_code=image_institution_code, scientific_name=scientific_name, genus=genus,
+        family=family, dataset=dataset, resolution=analysis['resolution'], content_hash=stored['content_hash'])
+    new_multimedia = model_text.Multimeida(**multimedia_row)
+    new_mul_extendMetadata = model_text.ExtendedImageMetadatum(**extended_row)
+
+    error = await run_db(commit_new, db, new_multimedia, new_mul_extendMetadata)
+    if error is not None:
+        os.remove(file_name)
+        # the same content may have been stored by a concurrent upload
+        existing = await run_db(get_multimedia_by_hash, db, stored['content_hash'])
+        if existing is not None:
+            return existing, None
+        return error
+    return new_multimedia, analysis
+
+
+# ark ids of the parent multimedias that exist
+def get_existing_arks(db: Session, ark_ids):
+    if len(ark_ids) == 0:
+        return set()
+    return set(db.execute(select(model_text.Multimeida.ark_id)
+                          .where(model_text.Multimeida.ark_id.in_(set(ark_ids)))).scalars())
+
+
+# insert multimedias and their extended metadata with batched multi-row inserts in one transaction
+# rows: [(multimedia row, extended row)], a chunk that fails is rolled back to its savepoint and inserted again
+# row by row, so a bad row only fails its own file
+# returns {ark_id: error} of the rows that were not inserted
+def insert_multimedias(db: Session, rows, chunk_size=1000):
+    errors = {}
+    parents = get_existing_arks(db, [multimedia_row['parent_ark_id'] for multimedia_row, _ in rows
+                                     if multimedia_row['parent_ark_id']])
+    for multimedia_row, _ in rows:
+        if multimedia_row['parent_ark_id'] and multimedia_row['parent_ark_id'] not in parents:
+            errors[multimedia_row['ark_id']] = "Sorry, there is no matched parent ARK ID."
+    rows = [row for row in rows if row[0]['ark_id'] not in errors]
+
+    def insert_rows(chunk):
+        with db.begin_nested():
+            db.execute(insert(model_text.Multimeida.__table__), [multimedia_row for multimedia_row, _ in chunk])
+            db.execute(insert(model_text.ExtendedImageMetadatum.__table__),
+                       [extended_row for _, extended_row in chunk])
 
     try:
-        db.add(new_multimedia)
-        db.add(new_mul_extendMetadata)
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            try:
+                insert_rows(chunk)
+            except exc.DBAPIError:
+                for row in chunk:
+                    try:
+                        insert_rows([row])
+                    except exc.DBAPIError as error:
+                        errors[row[0]['ark_id']] = str(error.orig)
         db.commit()
-        db.refresh(new_multimedia)
-        db.refresh(new_mul_extendMetadata)
-
-        return new_multimedia
     except Exception as error:
         db.rollback()
-        return str(error)
+        return {multimedia_row['ark_id']: str(error) for multimedia_row, _ in rows}
+    return errors
+
 
+# open a file object and store it as an image file, blocking, runs on a worker thread
+def store_file(open_file, filename, file_name):
+    with open_file() as source:
+        return store_image(source, filename, file_name)
 
-def get_multimedias(db: Session, genus, family, dataset, institution, max_width, min_width, max_height, min_height,
-                    batch_ark_id, zipfile, limit):
-    if genus is None:
-        genus = ''
-    if family is None:
-        family = ''
-    if institution is None:
-        institution = ''
-    if batch_ark_id is None:
-        batch_ark_id = ''
-    if min_height is None:
-        min_height = -1
-    if max_height is None:
-        max_height = -1
-    if min_width is None:
-        min_width = -1
-    if max_width is None:
-        max_width = -1
+
+# bulk upload into one batch
+# files: [(filename, open function)], open returns a binary file object that is read in chunks
+# defaults: field values for every file, manifest: {filename: field values} overriding the defaults
+# returns a result per file: {'filename', 'status': success/duplicate/failed, 'ark_id' or 'detail'},
+# duplicates of stored contents or of another file in the upload get the ark id of that multimedia
+async def create_multimedias(db: Session, batch_ark_id, files, defaults, manifest, concurrency=8):
+    matched_batch = await run_db(db.query(model_text.Batch).filter(model_text.Batch.ark_id == batch_ark_id).first)
+    if matched_batch is None:
+        return "Sorry, there is no matched batch ARK ID."
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def store(filename, open_file):
+        async with semaphore:
+            try:
+                ark_id = (await run_db(minter, config.ARK_MULTIMEDIA))[2]
+                file_name = multimedia_file_path(batch_ark_id, ark_id, file_format(filename))
+                stored = await run_db(store_file, open_file, filename, file_name)
+            except Exception as error:
+                return {'filename': filename, 'status': 'failed', 'detail': str(error)}
+            if isinstance(stored, str):
+                return {'filename': filename, 'status': 'failed', 'detail': stored}
+            return {'filename': filename, 'status': 'success', 'ark_id': ark_id, 'file': file_name,
+                    'stored': stored}
+
+    async def analyze(result):
+        async with semaphore:
+            filename = result['filename']
+            try:
+                analysis = await analyze_stored_image(result['file'])
+                if isinstance(analysis, str):
+                    result.update({'status': 'failed', 'detail': analysis})
+                    return
+                fields = dict(defaults)
+                fields.update(manifest.get(filename, {}))
+                result['rows'] = new_multimedia_rows(result['ark_id'], matched_batch, filename,
+                                                     analysis['width'], analysis['height'],
+                                                     result['stored']['size'], resolution=analysis['resolution'],
+                                                     content_hash=result['stored']['content_hash'], **fields)
+            except Exception as error:
+                os.remove(result['file'])
+                result.update({'status': 'failed', 'detail': str(error)})
+
+    results = await asyncio.gather(*(store(filename, open_file) for filename, open_file in files))
+    stored = [result for result in results if result['status'] == 'success']
+
+    # keep the first file of every content that is not stored yet
+    existing = await run_db(get_multimedia_arks_by_hash, db, [result['stored']['content_hash'] for result in stored])
+    first = {}
+    for result in stored:
+        content_hash = result['stored']['content_hash']
+        if content_hash in existing or content_hash in first:
+            os.remove(result['file'])
+            result['status'] = 'duplicate'
+            result['ark_id'] = existing.get(content_hash)
+            result['same_as'] = first.get(content_hash)
+        else:
+            first[content_hash] = result
+    await asyncio.gather(*(analyze(result) for result in first.values()))
+
+    new = [result for result in first.values() if result['status'] == 'success']
+    errors = await run_db(insert_multimedias, db, [result['rows'] for result in new])
+    failed = [result for result in new if result['ark_id'] in errors]
+    # the same content may have been stored by a concurrent upload
+    existing = await run_db(get_multimedia_arks_by_hash, db,
+                            [result['stored']['content_hash'] for result in failed])
+    for result in failed:
+        os.remove(result['file'])
+        ark_id = existing.get(result['stored']['content_hash'])
+        if ark_id is not None:
+            result.update({'status': 'duplicate', 'ark_id': ark_id})
+        else:
+            result.update({'status': 'failed', 'detail': errors[result['ark_id']]})
+    for result in results:
+        same_as = result.pop('same_as', None)
+        if same_as is not None and same_as['status'] == 'failed':
+            result.update({'status': 'failed', 'detail': same_as['detail']})
+        elif same_as is not None:
+            result['ark_id'] = same_as['ark_id']
+        if result['status'] == 'failed':
+            result.pop('ark_id', None)
+        for key in ('file', 'stored', 'rows'):
+            result.pop(key, None)
+    return results
+
+
+# levels of parents and children loaded around each multimedia of a JSON result
+HIERARCHY_DEPTH = 5
+
+
+# load the parent/child hierarchy of multimedias with one recursive query and link it in memory:
+# parents up to `depth` levels above each multimedia, then children up to `depth` levels below each of those,
+# parent/children beyond depth are left empty, so serializing the result runs no lazy loads
+@span('orm')
+def load_hierarchy(db: Session, multimedias, depth=HIERARCHY_DEPTH):
+    if len(multimedias) == 0:
+        return
+    multimedia = model_text.Multimeida
+    parent = aliased(model_text.Multimeida)
+    child = aliased(model_text.Multimeida)
+    ancestors = select(multimedia.ark_id, multimedia.parent_ark_id, literal(0).label('level')) \
+        .where(multimedia.ark_id.in_([row.ark_id for row in multimedias])) \
+        .cte('ancestors', recursive=True)
+    ancestors = ancestors.union_all(
+        select(parent.ark_id, parent.parent_ark_id, ancestors.c.level + 1)
+        .join(ancestors, parent.ark_id == ancestors.c.parent_ark_id)
+        .where(ancestors.c.level < depth))
+    descendants = select(ancestors.c.ark_id, literal(0).label('level')).cte('descendants', recursive=True)
+    descendants = descendants.union_all(
+        select(child.ark_id, descendants.c.level + 1)
+        .join(descendants, child.parent_ark_id == descendants.c.ark_id)
+        .where(descendants.c.level < depth))
+    hierarchy = select(descendants.c.ark_id, func.min(descendants.c.level).label('level')) \
+        .group_by(descendants.c.ark_id).subquery()
+    rows = db.query(multimedia, hierarchy.c.level) \
+        .join(hierarchy, multimedia.ark_id == hierarchy.c.ark_id) \
+        .options(joinedload(multimedia.extended_metadata),
+                 joinedload(multimedia.quality_metadata),
+                 joinedload(multimedia.batch)) \
+        .order_by(multimedia.ark_id).all()
+    nodes = {row.ark_id: row for row, _ in rows}
+    # children are complete for every multimedia expanded below depth
+    expanded = {row.ark_id for row, level in rows if level < depth}
+    children = {ark_id: [] for ark_id in expanded}
+    for row in nodes.values():
+        if row.parent_ark_id in children:
+            children[row.parent_ark_id].append(row)
+    for row in nodes.values():
+        set_committed_value(row, 'parent', nodes.get(row.parent_ark_id))
+        set_committed_value(row, 'children', children.get(row.ark_id, []))
+
+
+# multimedias in ARK ID order read from a server side cursor, yields lists of chunk_size ORM objects
+# with their metadata and hierarchy loaded, objects of a chunk are dropped from the session once the next is read
+def stream_multimedias(db: Session, limit=-1, chunk_size=500, depth=HIERARCHY_DEPTH, **filter_params):
+    statement = select(model_text.Multimeida).where(*multimedia_filters(**filter_params)) \
+        .order_by(model_text.Multimeida.ark_id)
+    if limit != -1:
+        statement = statement.limit(limit)
+    result = db.execute(statement, execution_options={"yield_per": chunk_size})
+    try:
+        for multimedias in span_iter(result.scalars().partitions(), 'orm'):
+            load_hierarchy(db, multimedias, depth)
+            yield multimedias
+            # expunge_all would replace the identity map the open result is still loading into
+            for loaded in list(db.identity_map.values()):
+                db.expunge(loaded)
+    finally:
+        result.close()
+
+
+@span('orm')
+def get_multimedias(db: Session, zipfile, limit, depth=HIERARCHY_DEPTH, **filter_params):
+    multimedia_query = get_multimedias_query(db, **filter_params)
+    # the batches only go into zip files, JSON results carry the batch of every multimedia
+    batch_results = []
     if zipfile is False:
-        multimedia_results = db.query(model_text.Multimeida). \
-            join(model_text.ExtendedImageMetadatum). \
-            filter(
-            or_(genus == '', model_text.Multimeida.genus.ilike('%' + genus + '%')),
-            or_(family == '', model_text.Multimeida.family.ilike('%' + family + '%')),
-            or_(institution == '', model_text.Multimeida.owner_institution_code == institution),
-            or_(batch_ark_id == '', model_text.Multimeida.batch_ark_id == batch_ark_id),
-            or_(min_height == -1, model_text.ExtendedImageMetadatum.height >= min_height),
-            or_(max_height == -1, model_text.ExtendedImageMetadatum.height <= max_height),
-            or_(min_width == -1, model_text.ExtendedImageMetadatum.width >= min_width),
-            or_(max_width == -1, model_text.ExtendedImageMetadatum.width <= max_width)
-        ).options(joinedload(model_text.Multimeida.extended_metadata),
-                  joinedload(model_text.Multimeida.quality_metadata),
-                  joinedload(model_text.Multimeida.batch)) \
-            .order_by(model_text.Multimeida.ark_id).limit(20).subquery()
+        limit = 20
     else:
-        multimedia_results = db.query(model_text.Multimeida). \
-            join(model_text.ExtendedImageMetadatum). \
-            filter(
-            or_(genus == '', model_text.Multimeida.genus.ilike('%' + genus + '%')),
-            or_(family == '', model_text.Multimeida.family.ilike('%' + family + '%')),
-            # or_(model_text.Multimeida.dataset.in_(dataset), dataset == None),
-            or_(institution == '', model_text.Multimeida.owner_institution_code == institution),
-            or_(batch_ark_id == '', model_text.Multimeida.batch_ark_id == batch_ark_id),
-            or_(min_height == -1, model_text.ExtendedImageMetadatum.height >= min_height),
-            or_(max_height == -1, model_text.ExtendedImageMetadatum.height <= max_height),
-            or_(min_width == -1, model_text.ExtendedImageMetadatum.width >= min_width),
-            or_(max_width == -1, model_text.ExtendedImageMetadatum.width <= max_width)
-        ).options(joinedload(model_text.Multimeida.extended_metadata),
-                  joinedload(model_text.Multimeida.quality_metadata),
-                  joinedload(model_text.Multimeida.batch)) \
-            .subquery()
-    batch_results = db.query(model_text.Batch).filter(
-        model_text.Batch.ark_id == multimedia_results.c.batch_ark_id).all()
-    if limit == -1:
-        if dataset is not None:
-            multimedia_results = db.query(model_text.Multimeida).select_entity_from(multimedia_results).filter(
-                model_text.Multimeida.dataset.in_(dataset)).all()
-        else:
-            multimedia_results = db.query(model_text.Multimeida).select_entity_from(multimedia_results).all()
+        batch_results = db.query(model_text.Batch).filter(
+            model_text.Batch.ark_id.in_(multimedia_query.with_entities(model_text.Multimeida.batch_ark_id))).all()
+    multimedia_query = multimedia_query.options(joinedload(model_text.Multimeida.extended_metadata),
+                                                joinedload(model_text.Multimeida.quality_metadata),
+                                                joinedload(model_text.Multimeida.batch)) \
+        .order_by(model_text.Multimeida.ark_id)
+    if limit != -1:
+        multimedia_query = multimedia_query.limit(limit)
+    multimedia_results = multimedia_query.all()
+    load_hierarchy(db, multimedia_results, depth)
+    return multimedia_results, batch_results
 
-    else:
-        if dataset is not None:
-            multimedia_results = db.query(model_text.Multimeida).select_entity_from(multimedia_results).filter(
-                model_text.Multimeida.dataset.in_(dataset)).order_by(model_text.Multimeida.ark_id).limit(limit).all()
-        else:
-            multimedia_results = db.query(model_text.Multimeida).select_entity_from(multimedia_results).order_by(
-                model_text.Multimeida.ark_id).limit(limit).all()
+
+# escape LIKE wildcards in user input, used with escape='\\'
+def like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# name filter by match mode: exact(=, btree index), prefix(ILIKE 'x%') or substring(ILIKE '%x%'),
+# both ILIKE modes are served by the pg_trgm indexes
+def name_filter(column, value, match):
+    if match == schemas.MatchMode.exact:
+        return column == value
+    if match == schemas.MatchMode.prefix:
+        return column.ilike(like_escape(value) + '%', escape='\\')
+    return column.ilike('%' + like_escape(value) + '%', escape='\\')
+
+
+# filter expressions shared by the ORM queries and the core export statements
+# only the filters which are set are emitted, so the planner gets a selective predicate for each request
+def multimedia_filters(genus=None, family=None, scientific_name=None, dataset=None, institution=None,
+                       max_width=None, min_width=None, max_height=None, min_height=None, batch_ark_id=None,
+                       match=schemas.MatchMode.substring, since=None):
+    filters = []
+    if genus:
+        filters.append(name_filter(model_text.Multimeida.genus, genus, match))
+    if family:
+        filters.append(name_filter(model_text.Multimeida.family, family, match))
+    if scientific_name:
+        filters.append(name_filter(model_text.Multimeida.scientific_name, scientific_name, match))
+    if institution:
+        filters.append(model_text.Multimeida.owner_institution_code == institution)
+    if batch_ark_id:
+        filters.append(model_text.Multimeida.batch_ark_id == batch_ark_id)
+    if dataset is not None:
+        filters.append(model_text.Multimeida.dataset.in_(dataset))
+    # image size lives in extended metadata: EXISTS instead of a join, so multimedias are never duplicated
+    size_filters = []
+    if min_height is not None:
+        size_filters.append(model_text.ExtendedImageMetadatum.height >= min_height)
+    if max_height is not None:
+        size_filters.append(model_text.ExtendedImageMetadatum.height <= max_height)
+    if min_width is not None:
+        size_filters.append(model_text.ExtendedImageMetadatum.width >= min_width)
+    if max_width is not None:
+        size_filters.append(model_text.ExtendedImageMetadatum.width <= max_width)
+    if size_filters:
+        filters.append(model_text.Multimeida.extended_metadata.any(and_(*size_filters)))
+    # delta: multimedias created or modified after the watermark, or whose extended or quality metadata was,
+    # modify_date is set on insert as well, each branch is a range scan of its modify date index
+    if since is not None:
+        filters.append(model_text.Multimeida.ark_id.in_(union(
+            select(model_text.Multimeida.ark_id).where(model_text.Multimeida.modify_date > since),
+            select(model_text.ExtendedImageMetadatum.ark_id).where(
+                model_text.ExtendedImageMetadatum.metadata_date > since),
+            select(model_text.ImageQualityMetadatum.ark_id).where(
+                model_text.ImageQualityMetadatum.modify_date > since))))
+    return filters
+
+
+# filtered multimedia query without eager loading or limit
+def get_multimedias_query(db: Session, **filter_params):
+    return db.query(model_text.Multimeida).filter(*multimedia_filters(**filter_params))
+
+
+# keyset pagination for JSON results: rows after the `after` ARK ID in ARK ID order,
+# returns the page and the cursor of the next page(None on the last page)
+@span('orm')
+def get_multimedia_page(db: Session, after=None, page_size=20, depth=HIERARCHY_DEPTH, **filter_params):
+    multimedia_query = get_multimedias_query(db, **filter_params)
+    if after is not None:
+        multimedia_query = multimedia_query.filter(model_text.Multimeida.ark_id > after)
+    multimedia_results = multimedia_query.options(joinedload(model_text.Multimeida.extended_metadata),
+                                                  joinedload(model_text.Multimeida.quality_metadata),
+                                                  joinedload(model_text.Multimeida.batch)) \
+        .order_by(model_text.Multimeida.ark_id).limit(page_size + 1).all()
+    next_cursor = None
+    if len(multimedia_results) > page_size:
+        multimedia_results = multimedia_results[:page_size]
+        next_cursor = multimedia_results[-1].ark_id
+    load_hierarchy(db, multimedia_results, depth)
+    return multimedia_results, next_cursor
+
+
+# columns of the csv(parquet) files in the export archive, in csv column order
+MULTIMEDIA_EXPORT_COLUMNS = [
+    model_text.Multimeida.ark_id, model_text.Multimeida.parent_ark_id, model_text.Multimeida.path,
+    model_text.Multimeida.create_date, model_text.Multimeida.modify_date,
+    model_text.Multimeida.filename_as_delivered, model_text.Multimeida.format,
+    model_text.Multimeida.scientific_name, model_text.Multimeida.genus, model_text.Multimeida.family,
+    model_text.Multimeida.batch_id, model_text.Multimeida.license, model_text.Multimeida.source,
+    model_text.Multimeida.owner_institution_code,
+]
+EXTENDED_EXPORT_COLUMNS = [
+    model_text.ExtendedImageMetadatum.ark_id, model_text.Multimeida.filename_as_delivered,
+    model_text.Multimeida.format, model_text.ExtendedImageMetadatum.create_date,
+    model_text.ExtendedImageMetadatum.metadata_date, model_text.ExtendedImageMetadatum.size,
+    model_text.ExtendedImageMetadatum.width, model_text.ExtendedImageMetadatum.height,
+    model_text.ExtendedImageMetadatum.license, model_text.ExtendedImageMetadatum.publisher,
+    model_text.ExtendedImageMetadatum.owner_institution_code,
+]
+QUALITY_EXPORT_COLUMNS = [
+    model_text.ImageQualityMetadatum.ark_id, model_text.ImageQualityMetadatum.license,
+    model_text.ImageQualityMetadatum.publisher, model_text.ImageQualityMetadatum.owner_institution_code,
+    model_text.ImageQualityMetadatum.create_date, model_text.ImageQualityMetadatum.metadata_date,
+    model_text.ImageQualityMetadatum.specimen_quantity, model_text.ImageQualityMetadatum.contains_scalebar,
+    model_text.ImageQualityMetadatum.contains_label, model_text.ImageQualityMetadatum.accession_number_validity,
+    model_text.ImageQualityMetadatum.contains_barcode, model_text.ImageQualityMetadatum.contains_colorbar,
+    model_text.ImageQualityMetadatum.non_specimen_objects, model_text.ImageQualityMetadatum.parts_overlapping,
+    model_text.ImageQualityMetadatum.specimen_angle, model_text.ImageQualityMetadatum.specimen_view,
+    model_text.ImageQualityMetadatum.specimen_curved, model_text.ImageQualityMetadatum.parts_missing,
+    model_text.ImageQualityMetadatum.all_parts_visible, model_text.ImageQualityMetadatum.parts_folded,
+    model_text.ImageQualityMetadatum.brightness, model_text.ImageQualityMetadatum.uniform_background,
+    model_text.ImageQualityMetadatum.on_focus, model_text.ImageQualityMetadatum.color_issue,
+    model_text.ImageQualityMetadatum.quality, model_text.ImageQualityMetadatum.data_capture_method,
+]
+BATCH_EXPORT_COLUMNS = [
+    model_text.Batch.ark_id, model_text.Batch.batch_name, model_text.Batch.institution_code,
+    model_text.Batch.pipeline, model_text.Batch.create_date, model_text.Batch.modify_date,
+    model_text.Batch.creator, model_text.Batch.creator_comment, model_text.Batch.contactor,
+    model_text.Batch.lab_code, model_text.Batch.project_name, model_text.Batch.code_repository,
+    model_text.Batch.dataset_name, model_text.Batch.bibliographic_citation, model_text.Batch.url,
+]
+EXPORT_COLUMNS = {
+    'multimedia': MULTIMEDIA_EXPORT_COLUMNS,
+    'extended': EXTENDED_EXPORT_COLUMNS,
+    'quality': QUALITY_EXPORT_COLUMNS,
+    'batch': BATCH_EXPORT_COLUMNS,
+}
+
+
+# execute a core statement on a server-side cursor when first iterated, yield lists of chunk_size row tuples
+def stream_rows(db: Session, statement, chunk_size=1000):
+    result = db.execute(statement, execution_options={"stream_results": True})
+    try:
+        for rows in result.partitions(chunk_size):
+            yield rows
+    finally:
+        result.close()
+
+
+# ark ids of the exported multimedias
+def export_multimedia_ids(limit=-1, **filter_params):
+    multimedia_ids = select(model_text.Multimeida.ark_id).where(*multimedia_filters(**filter_params))
+    if limit != -1:
+        multimedia_ids = multimedia_ids.order_by(model_text.Multimeida.ark_id).limit(limit)
+    return multimedia_ids.scalar_subquery()
+
+
+# for zip export: core statements returning plain tuples, one per csv file, no ORM objects are built
+def export_multimedias(db: Session, limit=-1, chunk_size=1000, **filter_params):
+    multimedia_ids = export_multimedia_ids(limit, **filter_params)
+
+    multimedia_statement = select(*MULTIMEDIA_EXPORT_COLUMNS). \
+        where(model_text.Multimeida.ark_id.in_(multimedia_ids)). \
+        order_by(model_text.Multimeida.ark_id)
+    extended_statement = select(*EXTENDED_EXPORT_COLUMNS). \
+        join(model_text.Multimeida, model_text.ExtendedImageMetadatum.ark_id == model_text.Multimeida.ark_id). \
+        where(model_text.Multimeida.ark_id.in_(multimedia_ids)). \
+        order_by(model_text.ExtendedImageMetadatum.ark_id)
+    quality_statement = select(*QUALITY_EXPORT_COLUMNS). \
+        where(model_text.ImageQualityMetadatum.ark_id.in_(multimedia_ids)). \
+        order_by(model_text.ImageQualityMetadatum.ark_id)
+    batch_filter = model_text.Batch.ark_id.in_(
+        select(model_text.Multimeida.batch_ark_id).where(model_text.Multimeida.ark_id.in_(multimedia_ids)))
+    since = filter_params.get('since')
+    if since is not None:
+        # delta: batches modified after the watermark are exported even if none of their multimedias changed
+        unchanged_params = dict(filter_params, since=None)
+        batch_filter = or_(batch_filter, and_(
+            model_text.Batch.modify_date > since,
+            model_text.Batch.ark_id.in_(
+                select(model_text.Multimeida.batch_ark_id).where(*multimedia_filters(**unchanged_params)))))
+    batch_statement = select(*BATCH_EXPORT_COLUMNS).where(batch_filter)
+
+    multimedia_results = {
+        'multimedia': stream_rows(db, multimedia_statement, chunk_size),
+        'extended': stream_rows(db, extended_statement, chunk_size),
+    }
+    if db.execute(select(quality_statement.exists())).scalar():
+        multimedia_results['quality'] = stream_rows(db, quality_statement, chunk_size)
+    batch_results = db.execute(batch_statement).all()
     return multimedia_results, batch_results
 
 
+# data version of the export tables: the latest modification of multimedias, extended metadata, batches and
+# quality metadata(index lookups), and the deletes counted by the data_version triggers(deleted rows leave the
+# modify dates unchanged)
+def data_watermark(db: Session):
+    return db.execute(select(
+        select(func.max(model_text.Multimeida.modify_date)).scalar_subquery(),
+        select(func.max(model_text.ExtendedImageMetadatum.metadata_date)).scalar_subquery(),
+        select(func.max(model_text.Batch.modify_date)).scalar_subquery(),
+        select(func.max(model_text.ImageQualityMetadatum.modify_date)).scalar_subquery(),
+        select(model_text.DataVersion.deletes).where(model_text.DataVersion.id == 1).scalar_subquery(),
+    )).one()
+
+
+# watermark of a delta export: the database time minus delta_lag_seconds, rows modified after it are returned
+# by the next delta export(since=watermark)
+# modify dates are set by the api when a row is built, a row committed later(e.g. at the end of a bulk upload)
+# carries an earlier date, the lag keeps such rows in the next delta, rows of the last delta_lag_seconds are
+# exported again
+def delta_watermark(db: Session):
+    now = db.execute(select(func.current_timestamp())).scalar()
+    return utc_datetime(now) - timedelta(seconds=delta_lag_seconds)
+
+
+def utc_datetime(value):
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+# export cache key: the export parameters and format, and the data watermark
+def export_cache_key(db: Session, filter_params, limit=-1, export_format='csv'):
+    return cache_key('zip', export_format, limit, filter_params, data_watermark(db))
+
+
+# rows of every csv file of an export, counted without reading them: {'multimedia', 'extended', 'quality'},
+# quality is left out when there are no quality rows, as in export_multimedias
+def count_export_rows(db: Session, limit=-1, **filter_params):
+    multimedia_ids = export_multimedia_ids(limit, **filter_params)
+    multimedia, extended, quality = db.execute(select(
+        select(func.count()).where(model_text.Multimeida.ark_id.in_(multimedia_ids)).scalar_subquery(),
+        select(func.count()).where(model_text.ExtendedImageMetadatum.ark_id.in_(multimedia_ids)).scalar_subquery(),
+        select(func.count()).where(model_text.ImageQualityMetadatum.ark_id.in_(multimedia_ids)).scalar_subquery(),
+    )).one()
+    rows = {'multimedia': multimedia, 'extended': extended}
+    if quality:
+        rows['quality'] = quality
+    return rows
+
+
+def count_multimedias(db: Session, limit=-1, **filter_params):
+    count = db.execute(select(func.count(model_text.Multimeida.ark_id))
+                       .where(*multimedia_filters(**filter_params))).scalar()
+    if limit != -1:
+        count = min(count, limit)
+    return count
+
+
 # for public
-def get_multimedia_public(db: Session, genus, family, dataset, zipfile, limit: int = 200):
-    if genus is None:
-        genus = ''
-    if family is None:
-        family = ''
-    if zipfile is False:
-        multimedia_results = db.query(model_text.Multimeida). \
-            join(model_text.ExtendedImageMetadatum). \
-            filter(
-            or_(genus == '', model_text.Multimeida.genus.ilike('%' + genus + '%')),
-            or_(family == '', model_text.Multimeida.family.ilike('%' + family + '%')),
-            or_(model_text.Multimeida.dataset == dataset, dataset == None),
-        ).options(joinedload(model_text.Multimeida.extended_metadata),
-                  joinedload(model_text.Multimeida.quality_metadata),
-                  joinedload(model_text.Multimeida.batch)) \
-            .limit(20).all()
-    else:
-        multimedia_results = db.query(model_text.Multimeida). \
-            join(model_text.ExtendedImageMetadatum). \
-            filter(
-            or_(genus == '', model_text.Multimeida.genus.ilike('%' + genus + '%')),
-            or_(family == '', model_text.Multimeida.family.ilike('%' + family + '%')),
-            or_(model_text.Multimeida.dataset == dataset, dataset == None),
-        ).options(joinedload(model_text.Multimeida.extended_metadata),
-                  joinedload(model_text.Multimeida.quality_metadata),
-                  joinedload(model_text.Multimeida.batch)) \
-            .limit(limit).all()
-    batch_results = db.query(model_text.Batch).join(model_text.Multimeida).filter(
-        model_text.Multimeida.genus.ilike('%' + genus + '%'),
-        model_text.Multimeida.family.ilike('%' + family + '%'),
-        or_(model_text.Multimeida.dataset == dataset, dataset == None)).all()
-    return multimedia_results, batch_results
+def get_multimedia_public(db: Session, genus, family, dataset, zipfile, limit: int = 200, depth=HIERARCHY_DEPTH):
+    return get_multimedias(db, zipfile=zipfile, limit=limit, depth=depth, genus=genus, family=family,
+                           dataset=None if dataset is None else [dataset])
+
+
+# cached thumbnail/preview of a stored image, generated on the image processes on a miss,
+# returns the derivative path or None when the multimedia or its stored original does not exist,
+# a stored original that can not be decoded raises its INVALID_IMAGE_ERRORS error
+async def get_multimedia_derivative(db: Session, ark_id, derivative):
+    multimedia = await run_db(db.query(model_text.Multimeida.batch_ark_id, model_text.Multimeida.format)
+                              .filter(model_text.Multimeida.ark_id == ark_id).first)
+    if multimedia is None:
+        return None
+    size = DERIVATIVE_SIZES[derivative]
+    key = cache_key(ark_id, derivative, size)
+    path = await run_db(derivative_cache.get, key)
+    if path is not None:
+        return path
+    source = multimedia_file_path(multimedia.batch_ark_id, ark_id, multimedia.format)
+    if not os.path.exists(source):
+        return None
+    try:
+        data = await image_analyzer.derive(source, size)
+    except FileNotFoundError:
+        return None
+    except INVALID_IMAGE_ERRORS as error:
+        logger.warning('invalid stored image %s: %r', source, error)
+        raise
+    return await run_db(derivative_cache.put, key, ark_id + "_" + derivative + ".jpg", data)
 
 
-def get_multimedia(db: Session, ark_id):
+@span('orm')
+def get_multimedia(db: Session, ark_id, depth=HIERARCHY_DEPTH):
     results = db.query(model_text.Multimeida) \
         .filter(
         model_text.Multimeida.ark_id == ark_id) \
         .options(joinedload(model_text.Multimeida.extended_metadata),
                  joinedload(model_text.Multimeida.quality_metadata)) \
         .all()
+    load_hierarchy(db, results, depth)
     if len(results) > 0:
         return (results[0])
     else:
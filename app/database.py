@@ -1,10 +1,19 @@
-from sqlalchemy import create_engine
+import logging
+import threading
+import time
+
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import QueuePool
+from starlette.concurrency import run_in_threadpool
+import anyio.to_thread
 import configparser
 
 config = configparser.ConfigParser()
 config.read('./config.ini')
 
+logger = logging.getLogger(__name__)
+
 db_user = config.get('database', 'user')
 db_password = config.get('database', 'password')
 db_host = config.get('database', 'localhost')
@@ -13,10 +22,135 @@ db_name = config.get('database', 'dbname')
 SQLALCHEMY_DATABASE_URL = (
    "postgresql+psycopg2://" + db_user + ":" + db_password + "@" + db_host + "/" + db_name
 )
+# a complete database url replaces the settings above, e.g. a local database for the benchmarks
+SQLALCHEMY_DATABASE_URL = config.get('database', 'url', fallback='') or SQLALCHEMY_DATABASE_URL
+
+
+class PoolStats:
+    """
+    connection pool counters: checkouts, time spent waiting for a connection, checkout failures,
+    time connections are held until they are checked in, new/invalidated connections
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.held_seconds_total = 0.0
+        self.held_seconds_max = 0.0
+        self.connects = 0
+        self.invalidations = 0
+
+    def record_wait(self, wait_seconds, failed=False):
+        with self._lock:
+            if failed:
+                self.checkout_failures += 1
+            self.wait_seconds_total += wait_seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+
+    def record_checkout(self, connection_record):
+        connection_record.info['checkout_time'] = time.perf_counter()
+        with self._lock:
+            self.checkouts += 1
+
+    def record_checkin(self, connection_record):
+        start = connection_record.info.pop('checkout_time', None)
+        if start is None:
+            return
+        held_seconds = time.perf_counter() - start
+        with self._lock:
+            self.held_seconds_total += held_seconds
+            self.held_seconds_max = max(self.held_seconds_max, held_seconds)
+
+    def record_connect(self):
+        with self._lock:
+            self.connects += 1
+
+    def record_invalidation(self):
+        with self._lock:
+            self.invalidations += 1
+
+
+pool_stats = PoolStats()
+
+
+class MeteredQueuePool(QueuePool):
+    # time every checkout from the pool, including the wait for a free connection
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            pool_stats.record_wait(time.perf_counter() - start, failed=True)
+            raise
+        pool_stats.record_wait(time.perf_counter() - start)
+        return connection
+
+
+pool_size = config.getint('database-pool', 'pool_size', fallback=20)
+max_overflow = config.getint('database-pool', 'max_overflow', fallback=25)
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
+    poolclass=MeteredQueuePool,
+    pool_size=pool_size,
+    max_overflow=max_overflow,
+    pool_timeout=config.getfloat('database-pool', 'pool_timeout', fallback=30),
+    pool_recycle=config.getint('database-pool', 'pool_recycle', fallback=1800),
+    pool_pre_ping=config.getboolean('database-pool', 'pool_pre_ping', fallback=True),
+    # sqlite connections are shared by the worker threads
+    connect_args={"check_same_thread": False} if SQLALCHEMY_DATABASE_URL.startswith("sqlite") else {},
 )
+event.listen(engine, "connect", lambda dbapi_connection, connection_record: pool_stats.record_connect())
+event.listen(engine, "checkout",
+             lambda dbapi_connection, connection_record, connection_proxy: pool_stats.record_checkout(connection_record))
+event.listen(engine, "checkin", lambda dbapi_connection, connection_record: pool_stats.record_checkin(connection_record))
+event.listen(engine, "invalidate",
+             lambda dbapi_connection, connection_record, exception: pool_stats.record_invalidation())
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
+
+# number of worker threads for blocking work: sync route handlers/dependencies, streamed responses and run_db
+db_threads = config.getint('database', 'threads', fallback=40)
+# every worker thread, export job worker and the explain thread of the slow request log may hold a connection,
+# with fewer connections threads wait up to pool_timeout for one and fail
+pool_demand = db_threads + config.getint('export-jobs', 'workers', fallback=2) + 1
+if pool_size + max_overflow < pool_demand:
+    logger.warning('database pool_size + max_overflow(%d) is smaller than the worker threads that may hold a '
+                   'connection(%d), requests will wait for connections under load',
+                   pool_size + max_overflow, pool_demand)
+
+
+# size the default worker thread limiter, must be called inside the event loop(app startup)
+def configure_threadpool():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = db_threads
+
+
+# run blocking database work from async code on the worker threads, the event loop keeps serving requests
+async def run_db(func, *args, **kwargs):
+    return await run_in_threadpool(func, *args, **kwargs)
+
+
+# current state of the connection pool and its counters
+def pool_metrics():
+    pool = engine.pool
+    metrics = {
+        "pool_size": pool.size() if hasattr(pool, "size") else None,
+        "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+        "checked_in": pool.checkedin() if hasattr(pool, "checkedin") else None,
+        # overflow() counts down from 0 while fewer than pool_size connections are open
+        "overflow": max(0, pool.overflow()) if hasattr(pool, "overflow") else None,
+        "max_overflow": max_overflow,
+        "checkouts": pool_stats.checkouts,
+        "checkout_failures": pool_stats.checkout_failures,
+        "wait_seconds_total": round(pool_stats.wait_seconds_total, 6),
+        "wait_seconds_max": round(pool_stats.wait_seconds_max, 6),
+        "held_seconds_total": round(pool_stats.held_seconds_total, 6),
+        "held_seconds_max": round(pool_stats.held_seconds_max, 6),
+        "connects": pool_stats.connects,
+        "invalidations": pool_stats.invalidations,
+    }
+    return metrics
@@ -0,0 +1,138 @@
+"""
+image analysis and derivatives: decoding, verification and resizing run in a pool of worker processes,
+away from the event loop
+"""
+import asyncio
+import configparser
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import ExifTags, Image, TiffImagePlugin, UnidentifiedImageError
+
+config = configparser.ConfigParser()
+config.read('./config.ini')
+
+
+# json friendly exif value, binary values are left out
+def exif_value(value):
+    if isinstance(value, bytes):
+        return None
+    if isinstance(value, TiffImagePlugin.IFDRational):
+        return float(value) if value.denominator else None
+    if isinstance(value, tuple):
+        return [exif_value(item) for item in value]
+    if isinstance(value, (int, float, str)):
+        return value
+    return str(value)
+
+
+# dimensions, resolution, color mode and exif of a stored image file, runs in a worker process
+def analyze_image(path):
+    # check the file structure beyond the header, raises for broken images
+    with Image.open(path) as image:
+        image.verify()
+    with Image.open(path) as image:
+        width, height = image.size
+        dpi = image.info.get('dpi')
+        exif = {}
+        for tag, value in image.getexif().items():
+            value = exif_value(value)
+            if value is not None:
+                exif[ExifTags.TAGS.get(tag, str(tag))] = value
+        analysis = {
+            "format": image.format,
+            "width": width,
+            "height": height,
+            "mode": image.mode,
+            "resolution": "%dx%d dpi" % (round(dpi[0]), round(dpi[1])) if dpi else None,
+            "exif": exif,
+        }
+    return analysis
+
+
+# longest side in pixels of each derivative
+DERIVATIVE_SIZES = {
+    "thumbnail": config.getint('derivatives', 'thumbnail', fallback=256),
+    "preview": config.getint('derivatives', 'preview', fallback=1024),
+}
+
+
+# jpeg of an image scaled down to fit size x size, runs in a worker process
+def make_derivative(path, size):
+    with Image.open(path) as image:
+        # jpeg sources are decoded at a reduced scale right away
+        image.draft('RGB', (size, size))
+        image.thumbnail((size, size))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=85, optimize=True)
+    return output.getvalue()
+
+
+# errors of files that can not be decoded as an image, the upload is refused
+INVALID_IMAGE_ERRORS = (UnidentifiedImageError, OSError, SyntaxError, Image.DecompressionBombError)
+
+
+# reason of an INVALID_IMAGE_ERRORS error for the client, the PIL messages carry the storage path of the file
+def invalid_image_reason(error):
+    if isinstance(error, UnidentifiedImageError):
+        return 'unknown image format'
+    if isinstance(error, Image.DecompressionBombError):
+        return 'too many pixels'
+    return 'truncated or corrupt image data'
+
+
+class ImageAnalysisError(Exception):
+    """
+    the image could not be processed for a reason on the server side, e.g. a worker process was terminated
+    """
+
+
+class ImageAnalyzer:
+    """
+    runs analyze_image and make_derivative on a process pool, at most max_pending images are queued or in work,
+    further callers wait for a free slot so a burst of uploads cannot pile up unbounded work
+    """
+
+    def __init__(self, workers=2, max_pending=16):
+        self.workers = workers
+        self._slots = asyncio.Semaphore(max_pending)
+        self._executor = None
+
+    # the pool is started on first use, spawned workers only import this module
+    def executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    async def run(self, func, *args):
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            executor = self.executor()
+            try:
+                return await loop.run_in_executor(executor, func, *args)
+            except BrokenProcessPool as error:
+                # a worker process died and the pool takes no more work, the next call starts a new pool
+                if self._executor is executor:
+                    self._executor = None
+                executor.shutdown(wait=False)
+                raise ImageAnalysisError('Image analysis is not available: ' + str(error)) from error
+
+    async def analyze(self, path):
+        return await self.run(analyze_image, str(path))
+
+    async def derive(self, path, size):
+        return await self.run(make_derivative, str(path), size)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+image_analyzer = ImageAnalyzer(workers=config.getint('image-analysis', 'workers', fallback=2),
+                               max_pending=config.getint('image-analysis', 'max_pending', fallback=16))
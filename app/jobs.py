@@ -0,0 +1,141 @@
+"""
+export jobs: zip exports built by a bounded pool of workers outside the request handlers
+"""
+import os
+import threading
+import uuid
+import configparser
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from app import crud
+from app.cache import export_cache
+from app.database import SessionLocal
+from app.metrics import ExportTimer
+from app.utils import watermark_token, zipfile_builder
+
+config = configparser.ConfigParser()
+config.read('./config.ini')
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class ExportJob:
+    def __init__(self, owner_id, filter_params, params, limit=-1, export_format='csv'):
+        self.job_id = str(uuid.uuid4())
+        self.owner_id = owner_id
+        self.filter_params = filter_params
+        self.params = params
+        self.limit = limit
+        self.export_format = export_format
+        self.watermark = None
+        self.cache_key = None
+        self.status = JOB_QUEUED
+        self.total_rows = None
+        self.rows = {}
+        self.filename = None
+        self.path = None
+        self.error = None
+        self.create_time = datetime.utcnow()
+        self.finish_time = None
+
+    # row counter around a csv row source, updated while the csv is written
+    def count_rows(self, csv_type, row_batches):
+        self.rows[csv_type] = 0
+        for rows in row_batches:
+            self.rows[csv_type] += len(rows)
+            yield rows
+
+    def progress(self):
+        if self.status == JOB_DONE:
+            return 1.0
+        if not self.total_rows:
+            return 0.0
+        return min(self.rows.get('multimedia', 0) / self.total_rows, 1.0)
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "export_format": self.export_format,
+            "watermark": watermark_token(self.watermark),
+            "total_rows": self.total_rows,
+            "rows": dict(self.rows),
+            "progress": round(self.progress(), 4),
+            "filename": self.filename,
+            "error": self.error,
+            "create_time": self.create_time,
+            "finish_time": self.finish_time,
+        }
+
+
+class ExportJobManager:
+    """
+    runs export jobs on a thread pool(database reads and zlib compression release the GIL),
+    at most max_pending jobs may be queued or running, the latest `retain` jobs are kept for status lookups
+    """
+
+    def __init__(self, workers=2, max_pending=20, retain=200):
+        self.max_pending = max_pending
+        self.retain = retain
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export-job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    # queue a new job, None if too many jobs are pending
+    def submit(self, owner_id, filter_params, params, limit=-1, export_format='csv'):
+        job = ExportJob(owner_id, filter_params, params, limit, export_format)
+        with self._lock:
+            pending = sum(1 for queued in self._jobs.values() if queued.status in (JOB_QUEUED, JOB_RUNNING))
+            if pending >= self.max_pending:
+                return None
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > self.retain:
+                self._jobs.popitem(last=False)
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job):
+        job.status = JOB_RUNNING
+        db = SessionLocal()
+        try:
+            job.watermark = crud.delta_watermark(db)
+            cache_key = job.cache_key = crud.export_cache_key(db, job.filter_params, job.limit, job.export_format)
+            path = export_cache.get(cache_key)
+            if path is None:
+                job.total_rows = crud.count_multimedias(db, limit=job.limit, **job.filter_params)
+                multimedia_res, batch_res = crud.export_multimedias(db, limit=job.limit, **job.filter_params)
+                multimedia_res = {csv_type: job.count_rows(csv_type, row_batches)
+                                  for csv_type, row_batches in multimedia_res.items()}
+                timer = ExportTimer(job.export_format)
+                zf = zipfile_builder(multimedia_res, batch_res, job.params, job.export_format,
+                                     crud.EXPORT_COLUMNS, timer)
+                for _ in export_cache.store(cache_key, zf.filename, timer.archive(zf)):
+                    pass
+                path = export_cache.get(cache_key)
+            else:
+                # built before, by a job or a zip request
+                job.rows = crud.count_export_rows(db, limit=job.limit, **job.filter_params)
+                job.total_rows = job.rows['multimedia']
+            job.path = path
+            job.filename = os.path.basename(path)
+            job.status = JOB_DONE
+        except Exception as error:
+            job.error = str(error)
+            job.status = JOB_FAILED
+        finally:
+            job.finish_time = datetime.utcnow()
+            db.close()
+
+
+export_jobs = ExportJobManager(workers=config.getint('export-jobs', 'workers', fallback=2),
+                               max_pending=config.getint('export-jobs', 'max_pending', fallback=20),
+                               retain=config.getint('export-jobs', 'retain', fallback=200))
@@ -1,17 +1,27 @@
+import csv
+import os
 from typing import List, Optional
+from zipfile import BadZipFile, LargeZipFile
 
 from fastapi import Depends, FastAPI, HTTPException, APIRouter, Response, Security, UploadFile, File, \
     Query, Form
 from fastapi.security.api_key import APIKeyHeader
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from sqlalchemy.orm import Session
 from starlette.status import HTTP_401_UNAUTHORIZED
 
-from app.utils import zipfile_generator, uploadFileValidation
-from . import crud, models, schemas
-from .database import SessionLocal, engine
+from app.utils import zipfile_builder, uploadFileValidation
+from . import crud, models, parquet, schemas, utils
+from .cache import export_cache
+from .compression import CompressionMiddleware, compression_options
+from .jobs import export_jobs, JOB_DONE
+from .metrics import ExportTimer, MetricsMiddleware, instrument_engine, metrics_enabled, registry
+from .profiling import ServerTimingMiddleware, profiling_options, slow_request_log
+from .database import SessionLocal, engine, configure_threadpool, pool_metrics, run_db
+from .imaging import INVALID_IMAGE_ERRORS, ImageAnalysisError, image_analyzer, invalid_image_reason
+from .serializers import json_response, ndjson_response
 import configparser
 
 config = configparser.ConfigParser()
@@ -22,6 +32,13 @@ apiKeyConfig = config.get('api-key', 'accesskey')
 # API key setting
 API_KEY = [apiKeyConfig]
 
+# browser cache lifetime of thumbnails and previews in seconds
+derivative_max_age = config.getint('derivatives', 'max_age', fallback=86400)
+
+# bulk upload limits
+bulk_upload_max_files = config.getint('bulk-upload', 'max_files', fallback=500)
+bulk_upload_concurrency = config.getint('bulk-upload', 'concurrency', fallback=8)
+
 api_key_header = APIKeyHeader(name="x-api-key", auto_error=False)
 
 models.Base.metadata.create_all(bind=engine)
@@ -42,6 +59,19 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"])
+# response compression negotiated from Accept-Encoding
+app.add_middleware(CompressionMiddleware, **compression_options())
+# Server-Timing spans of each request and the slow request log
+profiling = profiling_options()
+slow_log = slow_request_log(engine)
+# SQL statement timing, only hooked into the engine when metrics, Server-Timing or the slow request log use it
+if metrics_enabled or profiling['header'] or slow_log.enabled:
+    instrument_engine(engine)
+if profiling['header'] or slow_log.enabled:
+    app.add_middleware(ServerTimingMiddleware, router=app.router, slow_log=slow_log, **profiling)
+# request latency and database queries per route, outermost so the whole response is timed
+if metrics_enabled:
+    app.add_middleware(MetricsMiddleware, router=app.router)
 
 
 # custom OpenAPI
@@ -91,6 +121,17 @@ def custom_openapi():
 app.openapi = custom_openapi
 
 
+# sync handlers, dependencies and streamed responses run on the bounded worker thread pool
+@app.on_event("startup")
+def startup():
+    configure_threadpool()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    image_analyzer.shutdown()
+
+
 # Dependency
 def get_db():
     db = SessionLocal()
@@ -100,12 +141,77 @@ def get_db():
         db.close()
 
 
-async def get_api_key(db: Session = Depends(get_db),
-                      api_key_header: str = Security(api_key_header)
-                      ):
+# normalized multimedia filters, passed on to the crud query functions as keyword arguments
+def multimedia_filter_params(genus=None, family=None, scientific_name=None, dataset=None, institution=None,
+                             max_width=None, min_width=None, max_height=None, min_height=None, batch_ark_id=None,
+                             match=schemas.MatchMode.substring, since=None):
+    if dataset is not None:
+        dataset = sorted(name.value for name in dataset if name != schemas.DatasetName.none) or None
+    return {"genus": genus or None, "family": family or None, "scientific_name": scientific_name or None,
+            "dataset": dataset, "institution": institution or None, "max_width": max_width,
+            "min_width": min_width, "max_height": max_height, "min_height": min_height,
+            "batch_ark_id": batch_ark_id or None, "match": match, "since": parse_since(since)}
+
+
+# since parameter of delta exports: an ISO 8601 timestamp or the watermark token of a previous export
+def parse_since(since):
+    if not since:
+        return None
+    watermark = utils.parse_watermark(since)
+    if watermark is None:
+        raise HTTPException(status_code=400, detail="Invalid since. Use an ISO 8601 timestamp or a watermark token")
+    return watermark
+
+
+# X-Watermark header of delta requests(since given) and archives: pass it as since to the next request to get
+# only the rows created or modified after it
+def watermark_headers(db: Session, headers=None):
+    headers = dict(headers or {})
+    headers['X-Watermark'] = utils.watermark_token(crud.delta_watermark(db))
+    return headers
+
+
+# zip export of the filtered multimedias, served from export_cache when the same export was built
+# before and the data did not change since
+# streaming: send zip chunks while they are compressed, otherwise the archive is completely built first
+# export_format: csv or parquet files in the archive
+def export_response(db: Session, filter_params, params, streaming: bool = True, limit: int = -1,
+                    export_format: schemas.ExportFormat = schemas.ExportFormat.csv):
+    check_export_format(export_format)
+    # read before the rows, so nothing modified while the archive is built is left out of the next delta
+    headers = watermark_headers(db)
+    cache_key = crud.export_cache_key(db, filter_params, limit, export_format)
+    path = export_cache.get(cache_key)
+    if path is None:
+        multimedia_res, batch_res = crud.export_multimedias(db, limit=limit, **filter_params)
+        timer = ExportTimer(export_format)
+        zf = zipfile_builder(multimedia_res, batch_res, params, export_format, crud.EXPORT_COLUMNS, timer)
+        chunks = export_cache.store(cache_key, zf.filename, timer.archive(zf))
+        if streaming:
+            headers.update({'X-filename': zf.filename,
+                            'Content-Disposition': 'attachment; filename="' + zf.filename + '"'})
+            return StreamingResponse(chunks, media_type="application/zip", headers=headers)
+        for _ in chunks:
+            pass
+        path = export_cache.get(cache_key)
+    filename = os.path.basename(path)
+    headers['X-filename'] = filename
+    return FileResponse(path=path, filename=filename, headers=headers)
+
+
+# parquet files are written with pyarrow, which is an optional dependency
+def check_export_format(export_format):
+    if export_format == schemas.ExportFormat.parquet and parquet.pyarrow is None:
+        raise HTTPException(status_code=400, detail="Parquet export is not available on this server")
+
+
+# resolve the api key once per request, returns the user: {'api_key', 'people_id', 'name'}
+def get_api_key(db: Session = Depends(get_db),
+                api_key_header: str = Security(api_key_header)
+                ):
     api_key_user = crud.get_people_by_apikey(db, api_key_header)
     if 'api_key' in api_key_user.keys():
-        return api_key_user['api_key']
+        return api_key_user
     else:
         raise HTTPException(
             status_code=HTTP_401_UNAUTHORIZED, detail="Invalid Token"
@@ -113,9 +219,9 @@ async def get_api_key(db: Session = Depends(get_db),
 
 
 @router.post("/create_your_key", tags=["Authorization"])
-async def generate_api_key(firstName: str = Form(...), lastName: str = Form(...), email: str = Form(...),
-                           purpose: str = Form(...), passcode: str = Form(...),
-                           db: Session = Depends(get_db)):
+def generate_api_key(firstName: str = Form(...), lastName: str = Form(...), email: str = Form(...),
+                     purpose: str = Form(...), passcode: str = Form(...),
+                     db: Session = Depends(get_db)):
     '''
         PUBLIC METHOD
         Create a new api key for yourself
@@ -141,8 +247,8 @@ async def generate_api_key(firstName: str = Form(...), lastName: str = Form(...)
 
 
 @router.post("/get_your_key", tags=["Authorization"])
-async def get_apikey(email: str = Form(...), passcode: str = Form(...),
-                     db: Session = Depends(get_db)):
+def get_apikey(email: str = Form(...), passcode: str = Form(...),
+               db: Session = Depends(get_db)):
     '''
         PUBLIC METHOD
         Get the api key you created
@@ -166,19 +272,26 @@ async def get_apikey(email: str = Form(...), passcode: str = Form(...),
 
 @router.get("/multimedias/", tags=["Multimedia"], response_model=List[schemas.MultimediaChild])
 # async def read_multimedias(response: Response, genus: Optional[str] = None, dataset: schemas.DatasetName = schemas.DatasetName.glindataset, min_height: Optional[int] = None, max_height: Optional[int] = None, limit: Optional[int] = None, zipfile: bool = True,
-async def read_multimedias(response: Response, api_key: str = Security(get_api_key), genus: Optional[str] = None,
-                           family: Optional[str] = None, dataset: Optional[List[schemas.DatasetName]] = Query(None),
-                           institution: Optional[str] = None,
-                           maxWidth: Optional[int] = None, minWidth: Optional[int] = None,
-                           maxHeight: Optional[int] = None,
-                           minHeight: Optional[int] = None, batchARKID: Optional[str] = None, zipfile: bool = True,
-                           db: Session = Depends(get_db)
-                           ):
+def read_multimedias(response: Response, user: dict = Security(get_api_key), genus: Optional[str] = None,
+                     family: Optional[str] = None, dataset: Optional[List[schemas.DatasetName]] = Query(None),
+                     scientificName: Optional[str] = None, match: schemas.MatchMode = schemas.MatchMode.substring,
+                     institution: Optional[str] = None,
+                     maxWidth: Optional[int] = None, minWidth: Optional[int] = None,
+                     maxHeight: Optional[int] = None,
+                     minHeight: Optional[int] = None, batchARKID: Optional[str] = None, zipfile: bool = True,
+                     streaming: bool = True, after: Optional[str] = None,
+                     page_size: int = Query(20, ge=1, le=1000), depth: int = Query(crud.HIERARCHY_DEPTH, ge=0, le=20),
+                     format: Optional[schemas.ResponseFormat] = None,
+                     exportFormat: schemas.ExportFormat = schemas.ExportFormat.csv, since: Optional[str] = None,
+                     db: Session = Depends(get_db)
+                     ):
     '''
         PRIVATE METHOD
         get multimedias and associated (meta)data, like IQ, extended metadata, hirecachy medias
         - param genus: species genus
         - param family: species family
+        - param scientificName: scientific name
+        - param match: how genus/family/scientificName are matched: substring(default), prefix or exact
         - param institution: institution code
         - param dataset: dataset name(multiple selection)
         - param maxWidth: max width of image
@@ -187,40 +300,60 @@ async def read_multimedias(response: Response, api_key: str = Security(get_api_k
         - param minHeight: min height of image
         - param batchARKID: batch ARK ID
         - param zipfile: return JSON or Zip file
-        - return: multimedia lists(with associated (meta)data). If zipfile is false, it will return 20 records(pagination will be added later)
+        - param format: zip, json or ndjson(one JSON record per line for all matching records, streamed while
+          they are read), overrides zipfile
+        - param exportFormat: zip only, files in the archive: csv(default) or parquet(typed, compressed columns)
+        - param since: delta export, only records created or modified after this ISO 8601 timestamp or
+          watermark token(the X-Watermark response header of a previous request)
+        - param streaming: stream the zip file while it is built(default) or build it on the server first
+        - param after: JSON only, return records after this ARK ID (the X-Next-Cursor of the previous page)
+        - param page_size: JSON only, number of records per page (default 20, max 1000)
+        - param depth: JSON/ndjson only, levels of parent and child multimedias nested in each record (default 5)
+        - return: multimedia lists(with associated (meta)data). If zipfile is false, it will return a page of
+          records ordered by ARK ID, the X-Next-Cursor response header holds the cursor of the next page.
+          The X-Watermark response header of zip files and requests with since holds the since value of the
+          next delta export
     '''
-    if dataset == schemas.DatasetName.none:
-        dataset = None
+    filter_params = multimedia_filter_params(genus=genus, family=family, scientific_name=scientificName,
+                                             dataset=dataset, institution=institution, max_width=maxWidth,
+                                             min_width=minWidth, max_height=maxHeight, min_height=minHeight,
+                                             batch_ark_id=batchARKID, match=match, since=since)
     # multimedia_res, batch_res = crud.get_multimedias(db, genus=genus, dataset=dataset,min_height=min_height,max_height=max_height, limit=limit)
-    multimedia_res, batch_res = crud.get_multimedias(db, genus=genus, family=family, dataset=dataset, zipfile=zipfile,
-                                                     institution=institution,
-                                                     max_width=maxWidth, max_height=maxHeight, min_width=minWidth,
-                                                     min_height=minHeight,
-                                                     batch_ark_id=batchARKID, limit=-1)
-    if zipfile:
-        # path, filename = zipfile_generator(multimedia_res, batch_res, params={"genus": genus, "dataset": dataset, "min_height": min_height, "max_height": max_height,"limit": limit})
-        path, filename = zipfile_generator(multimedia_res, batch_res,
-                                           params={"genus": genus, "family": family, "dataset": dataset})
-        response.headers['X-filename'] = filename
-        return FileResponse(path=path, filename=filename)
-    return multimedia_res
+    if format == schemas.ResponseFormat.ndjson:
+        headers = watermark_headers(db) if filter_params['since'] is not None else None
+        return ndjson_response(schemas.MultimediaChild,
+                               crud.stream_multimedias(db, depth=depth, **filter_params), headers=headers)
+    if format == schemas.ResponseFormat.zip or (format is None and zipfile):
+        # stream rows from the database into the csv files of the archive
+        return export_response(db, filter_params, params={"genus": genus, "family": family, "dataset": dataset},
+                               streaming=streaming, export_format=exportFormat)
+    multimedia_res, next_cursor = crud.get_multimedia_page(db, after=after, page_size=page_size, depth=depth,
+                                                         **filter_params)
+    headers = watermark_headers(db) if filter_params['since'] is not None else {}
+    if next_cursor is not None:
+        headers['X-Next-Cursor'] = next_cursor
+    return json_response(schemas.MultimediaChild, multimedia_res, headers=headers)
 
 
 @router.get("/multimedias_demo/", tags=["Multimedia"], response_model=List[schemas.MultimediaChild])
 # async def read_multimedias(response: Response, genus: Optional[str] = None, dataset: schemas.DatasetName = schemas.DatasetName.glindataset, min_height: Optional[int] = None, max_height: Optional[int] = None, limit: Optional[int] = None, zipfile: bool = True,
-async def read_multimedias(response: Response, genus: Optional[str] = None,
-                           family: Optional[str] = None, dataset: Optional[List[schemas.DatasetName]] = Query(None),
-                           institution: Optional[str] = None,
-                           maxWidth: Optional[int] = None, minWidth: Optional[int] = None,
-                           maxHeight: Optional[int] = None,
-                           minHeight: Optional[int] = None, batchARKID: Optional[str] = None, zipfile: bool = True,
-                           db: Session = Depends(get_db)
-                           ):
+def read_multimedias(response: Response, genus: Optional[str] = None,
+                     family: Optional[str] = None, dataset: Optional[List[schemas.DatasetName]] = Query(None),
+                     scientificName: Optional[str] = None, match: schemas.MatchMode = schemas.MatchMode.substring,
+                     institution: Optional[str] = None,
+                     maxWidth: Optional[int] = None, minWidth: Optional[int] = None,
+                     maxHeight: Optional[int] = None,
+                     minHeight: Optional[int] = None, batchARKID: Optional[str] = None, zipfile: bool = True,
+                     streaming: bool = True, depth: int = Query(crud.HIERARCHY_DEPTH, ge=0, le=20),
+                     exportFormat: schemas.ExportFormat = schemas.ExportFormat.csv, db: Session = Depends(get_db)
+                     ):
     '''
         PUBLIC METHOD
         A demo for getting multimedias and associated (meta)data, like IQ, extended metadata, hirecachy medias
         - param genus: species genus
         - param family: species family
+        - param scientificName: scientific name
+        - param match: how genus/family/scientificName are matched: substring(default), prefix or exact
         - param institution: institution code
         - param dataset: dataset name(multiple selection)
         - param maxWidth: max width of image
@@ -229,31 +362,32 @@ async def read_multimedias(response: Response, genus: Optional[str] = None,
         - param minHeight: min height of image
         - param batchARKID: batch ARK ID
         - param zipfile: return JSON or Zip file
+        - param exportFormat: zip only, files in the archive: csv(default) or parquet(typed, compressed columns)
+        - param streaming: stream the zip file while it is built(default) or build it on the server first
+        - param depth: JSON only, levels of parent and child multimedias nested in each record (default 5)
         - return: a list of 200 multimedias (with associated (meta)data). If zipfile is false, it will return 20 records
     '''
-    if dataset == schemas.DatasetName.none:
-        dataset = None
+    filter_params = multimedia_filter_params(genus=genus, family=family, scientific_name=scientificName,
+                                             dataset=dataset, institution=institution, max_width=maxWidth,
+                                             min_width=minWidth, max_height=maxHeight, min_height=minHeight,
+                                             batch_ark_id=batchARKID, match=match)
     # multimedia_res, batch_res = crud.get_multimedias(db, genus=genus, dataset=dataset,min_height=min_height,max_height=max_height, limit=limit)
-    multimedia_res, batch_res = crud.get_multimedias(db, genus=genus, family=family, dataset=dataset, zipfile=zipfile,
-                                                     institution=institution,
-                                                     max_width=maxWidth, max_height=maxHeight, min_width=minWidth,
-                                                     min_height=minHeight,
-                                                     batch_ark_id=batchARKID, limit=200)
     if zipfile:
-        # path, filename = zipfile_generator(multimedia_res, batch_res, params={"genus": genus, "dataset": dataset, "min_height": min_height, "max_height": max_height,"limit": limit})
-        path, filename = zipfile_generator(multimedia_res, batch_res,
-                                           params={"genus": genus, "family": family, "dataset": dataset})
-        response.headers['X-filename'] = filename
-        return FileResponse(path=path, filename=filename)
-    return multimedia_res
+        return export_response(db, filter_params, params={"genus": genus, "family": family, "dataset": dataset},
+                               streaming=streaming, limit=200, export_format=exportFormat)
+    multimedia_res, batch_res = crud.get_multimedias(db, zipfile=zipfile, limit=200, depth=depth, **filter_params)
+    return json_response(schemas.MultimediaChild, multimedia_res)
 
 
 @router.get("/multimedia_public/", tags=["Multimedia"], response_model=List[schemas.MultimediaChild])
 # async def read_multimedias(response: Response, genus: Optional[str] = None, dataset: schemas.DatasetName = schemas.DatasetName.glindataset, min_height: Optional[int] = None, max_height: Optional[int] = None, limit: Optional[int] = None, zipfile: bool = True,
-async def read_multimedias_public(response: Response, genus: Optional[str] = None, family: Optional[str] = None,
-                                  dataset: schemas.DatasetName = schemas.DatasetName.glindataset, zipfile: bool = True,
-                                  db: Session = Depends(get_db)
-                                  ):
+def read_multimedias_public(response: Response, genus: Optional[str] = None, family: Optional[str] = None,
+                            dataset: schemas.DatasetName = schemas.DatasetName.glindataset, zipfile: bool = True,
+                            streaming: bool = True, depth: int = Query(crud.HIERARCHY_DEPTH, ge=0, le=20),
+                            format: Optional[schemas.ResponseFormat] = None,
+                            exportFormat: schemas.ExportFormat = schemas.ExportFormat.csv,
+                            db: Session = Depends(get_db)
+                            ):
     '''
         PUBLIC METHOD - for students
         get multimedias and associated (meta)data, like IQ, extended metadata, hirecachy medias
@@ -261,36 +395,154 @@ async def read_multimedias_public(response: Response, genus: Optional[str] = Non
         - param family: species family
         - param dataset: dataset name
         - param zipfile: return JSON or Zip file
-        - return: multimedia lists(with associated (meta)data)
+        - param format: zip, json or ndjson(one JSON record per line, streamed while they are read),
+          overrides zipfile
+        - param exportFormat: zip only, files in the archive: csv(default) or parquet(typed, compressed columns)
+        - param streaming: stream the zip file while it is built(default) or build it on the server first
+        - param depth: JSON/ndjson only, levels of parent and child multimedias nested in each record (default 5)
+        - return: multimedia lists(with associated (meta)data), at most 200 records
     '''
     # multimedia_res, batch_res = crud.get_multimedias(db, genus=genus, dataset=dataset,min_height=min_height,max_height=max_height, limit=limit)
-    multimedia_res, batch_res = crud.get_multimedia_public(db, genus=genus, family=family, dataset=dataset, limit=200,
-                                                           zipfile=zipfile)
-    if zipfile:
-        # path, filename = zipfile_generator(multimedia_res, batch_res, params={"genus": genus, "dataset": dataset, "min_height": min_height, "max_height": max_height,"limit": limit})
-        path, filename = zipfile_generator(multimedia_res, batch_res,
-                                           params={"genus": genus, "family": family, "dataset": dataset})
-        response.headers['X-filename'] = filename
-        return FileResponse(path=path, filename=filename)
-    return multimedia_res
+    filter_params = multimedia_filter_params(genus=genus, family=family,
+                                             dataset=None if dataset is None else [dataset])
+    if format == schemas.ResponseFormat.ndjson:
+        return ndjson_response(schemas.MultimediaChild,
+                               crud.stream_multimedias(db, limit=200, depth=depth, **filter_params))
+    if format == schemas.ResponseFormat.zip or (format is None and zipfile):
+        return export_response(db, filter_params, params={"genus": genus, "family": family, "dataset": dataset},
+                               streaming=streaming, limit=200, export_format=exportFormat)
+    multimedia_res, batch_res = crud.get_multimedia_public(db, genus=genus, family=family, dataset=dataset,
+                                                           limit=200, zipfile=False, depth=depth)
+    return json_response(schemas.MultimediaChild, multimedia_res)
+
+
+@router.post("/exports/", tags=["Export"])
+async def create_export(user: dict = Security(get_api_key),
+                        genus: Optional[str] = Form(None), family: Optional[str] = Form(None),
+                        scientificName: Optional[str] = Form(None),
+                        match: schemas.MatchMode = Form(schemas.MatchMode.substring),
+                        dataset: Optional[List[schemas.DatasetName]] = Form(None),
+                        institution: Optional[str] = Form(None),
+                        maxWidth: Optional[int] = Form(None), minWidth: Optional[int] = Form(None),
+                        maxHeight: Optional[int] = Form(None), minHeight: Optional[int] = Form(None),
+                        batchARKID: Optional[str] = Form(None),
+                        exportFormat: schemas.ExportFormat = Form(schemas.ExportFormat.csv),
+                        since: Optional[str] = Form(None)):
+    '''
+        PRIVATE METHOD
+        start building a zip export in the background, same filters as /multimedias/
+        - param exportFormat: files in the archive: csv(default) or parquet(typed, compressed columns)
+        - param since: delta export, only records created or modified after this ISO 8601 timestamp or
+          watermark token(the watermark of a previous export)
+        - return: export job id and status, poll /exports/{job_id} until the status is done
+    '''
+    filter_params = multimedia_filter_params(genus=genus, family=family, scientific_name=scientificName,
+                                             dataset=dataset, institution=institution, max_width=maxWidth,
+                                             min_width=minWidth, max_height=maxHeight, min_height=minHeight,
+                                             batch_ark_id=batchARKID, match=match, since=since)
+    check_export_format(exportFormat)
+    job = export_jobs.submit(user['people_id'], filter_params,
+                             params={"genus": genus, "family": family, "dataset": dataset},
+                             export_format=exportFormat)
+    if job is None:
+        raise HTTPException(status_code=429, detail="Too many exports in progress. Please try again later")
+    return job.to_dict()
+
+
+def get_export_job(job_id, user):
+    job = export_jobs.get(job_id)
+    if job is None or job.owner_id != user['people_id']:
+        raise HTTPException(status_code=404, detail="Export Not Found")
+    return job
+
+
+@router.get("/exports/{job_id}", tags=["Export"])
+async def read_export(job_id: str, user: dict = Security(get_api_key)):
+    '''
+        PRIVATE METHOD
+        status of an export job
+        - return: status(queued/running/done/failed), row counts per csv file and progress(0 to 1)
+    '''
+    return get_export_job(job_id, user).to_dict()
+
+
+@router.get("/exports/{job_id}/download", tags=["Export"])
+async def download_export(job_id: str, user: dict = Security(get_api_key)):
+    '''
+        PRIVATE METHOD
+        download the zip file of a finished export job
+    '''
+    job = get_export_job(job_id, user)
+    if job.status != JOB_DONE:
+        raise HTTPException(status_code=409, detail="Export is " + job.status)
+    # marks the archive as recently used, it is not evicted while it is sent
+    path = export_cache.get(job.cache_key)
+    if path is None:
+        raise HTTPException(status_code=410, detail="Export expired. Please create it again")
+    return FileResponse(path=path, filename=job.filename, headers={'X-filename': job.filename})
+
+
+@router.get("/pool/", tags=["Monitoring"])
+def read_pool_metrics(user: dict = Security(get_api_key)):
+    '''
+        PRIVATE METHOD
+        database connection pool state: pool size, checked out connections, overflow in use,
+        checkout count and failures, time waiting for and holding connections, new and invalidated connections
+    '''
+    return pool_metrics()
+
+
+@router.get("/metrics", tags=["Monitoring"], response_class=PlainTextResponse)
+def read_metrics():
+    '''
+        PUBLIC METHOD
+        metrics in the Prometheus text format: request latency, requests in flight and SQL statements per route,
+        export phase timings and the connection pool state
+    '''
+    if not metrics_enabled:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 
 @router.get("/multimedia/{ARKID}", tags=["Multimedia"], response_model=schemas.MultimediaChild)
-async def read_multimedia_arkid(ARKID: str = 'qs243w0c', db: Session = Depends(get_db)):
+def read_multimedia_arkid(ARKID: str = 'qs243w0c', depth: int = Query(crud.HIERARCHY_DEPTH, ge=0, le=20), db: Session = Depends(get_db)):
     '''
         PUBLIC METHOD
          get multimedia and associated (meta)data, like IQ, extended metadata, hirecachy medias by ARK ID
     - param arkid: ark id (exp: qs243w0c)
+    - param depth: levels of parent and child multimedias nested in the entity (default 5)
     - return: multimedia entity
     '''
-    iqs = crud.get_multimedia(db, ark_id=ARKID.strip())
+    iqs = crud.get_multimedia(db, ark_id=ARKID.strip(), depth=depth)
     if iqs is None:
         raise HTTPException(status_code=404, detail="Image Not Found")
-    return iqs
+    return json_response(schemas.MultimediaChild, iqs)
+
+
+@router.get("/multimedia/{ARKID}/{derivative}", tags=["Multimedia"], response_class=FileResponse)
+async def read_multimedia_derivative(derivative: schemas.DerivativeName, ARKID: str = 'qs243w0c',
+                                     db: Session = Depends(get_db)):
+    '''
+        PUBLIC METHOD
+         get a scaled down jpeg copy of a multimedia by ARK ID
+    - param arkid: ark id (exp: qs243w0c)
+    - param derivative: thumbnail/preview
+    - return: jpeg image, 422 when the stored original can not be decoded
+    '''
+    try:
+        path = await crud.get_multimedia_derivative(db, ARKID.strip(), derivative.value)
+    except ImageAnalysisError as error:
+        raise HTTPException(status_code=503, detail=str(error))
+    except INVALID_IMAGE_ERRORS as error:
+        raise HTTPException(status_code=422, detail="Stored image can not be decoded: " + invalid_image_reason(error))
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image Not Found")
+    return FileResponse(path, media_type="image/jpeg",
+                        headers={"Cache-Control": "public, max-age=" + str(derivative_max_age)})
 
 
 # @router.get("/iq/", tags=["Image Quality Metadata"], response_model=List[schemas.IQ])
-# async def read_iqs(api_key: str = Security(get_api_key), skip: int = 0, limit: int = 100,
+# async def read_iqs(user: dict = Security(get_api_key), skip: int = 0, limit: int = 100,
 #                    db: Session = Depends(get_db)):
 #     '''
 #         PRIVATE METHOD
@@ -304,7 +556,7 @@ async def read_multimedia_arkid(ARKID: str = 'qs243w0c', db: Session = Depends(g
 
 
 @router.post("/batch/", tags=['Batch'], response_model=schemas.BatchMetadatum)
-async def create_batch(api_key: str = Security(get_api_key),
+async def create_batch(user: dict = Security(get_api_key),
                        institutionCode: str = Form(None),
                        batchName: str = Form(None),
                        pipeline: schemas.Pipeline = Form(None),
@@ -334,15 +586,15 @@ async def create_batch(api_key: str = Security(get_api_key),
     batch = await crud.create_batch(db, institution=institutionCode, pipeline=pipeline, batchName=batchName,
                                     comment=creatorComments, codeRepo=codeRepository, url=URL,
                                     dataset=datasetName, citation=bibliographicCitation, supplement_file=supplementFile,
-                                    api_key=api_key)
+                                    user=user)
     if batch is None or isinstance(batch, str):
         raise HTTPException(status_code=404, detail="New batch creation failed. Please try again")
     return batch
 
 
 @router.get("/batch/{batchARKID}", tags=['Batch'], response_model=schemas.BatchMetadatum)
-async def get_batch(batchARKID: str, api_key: str = Security(get_api_key),
-                    db: Session = Depends(get_db)):
+def get_batch(batchARKID: str, user: dict = Security(get_api_key),
+              db: Session = Depends(get_db)):
     '''
         PRIVATE METHOD
         get batch by batch ark id
@@ -364,14 +616,14 @@ async def get_batch(batchARKID: str, api_key: str = Security(get_api_key),
 
 
 @router.get("/batch/", tags=['Batch'], response_model=List[schemas.BatchMetadatum])
-async def get_batchlist(api_key: str = Security(get_api_key),
-                        db: Session = Depends(get_db)):
+def get_batchlist(user: dict = Security(get_api_key),
+                  db: Session = Depends(get_db)):
     '''
         PRIVATE METHOD
         return all batches by user
         - return: Batches
     '''
-    batches = crud.get_batch_list(db, api_key)
+    batches = crud.get_batch_list(db, user)
     if isinstance(batches, str):
         raise HTTPException(status_code=400, detail="Retrieve batches failed.")
     return batches
@@ -383,13 +635,14 @@ async def upload_image(batchARKID: str = Form(...),
                        scientificName: str = Form(...),
                        genus: str = Form(...),
                        family: str = Form(...),
-                       api_key: str = Security(get_api_key),
+                       user: dict = Security(get_api_key),
                        file: UploadFile = File(..., description="image file"),
                        parentARKID: str = Form(None),
                        license: str = Form(None),
                        source: str = Form(None),
                        ownerInstitutionCode: str = Form(None),
                        dataset: schemas.DatasetName = Form(None),
+                       onDuplicate: schemas.DuplicateMode = Form(schemas.DuplicateMode.link),
                        db: Session = Depends(get_db)):
     '''
         PRIVATE METHOD
@@ -404,19 +657,118 @@ async def upload_image(batchARKID: str = Form(...),
         - param: genus:
         - param: family:
         - param: dataset: (segmentation/landmark/boundingbox)
-        - return: upload success/failure and associate message
+        - param: onDuplicate: link(default): an image that was uploaded before returns its existing ark id,
+          reject: an image that was uploaded before is refused with 409
+        - return: upload success/failure and associate message, with the analysed image properties
+          (format, width, height, mode, resolution, exif)
     '''
     image_validate_error = uploadFileValidation(file)
     if image_validate_error != '':
         raise HTTPException(status_code=400, detail=image_validate_error)
-    new_multimedia = await crud.create_multimedia(
-        db, file, batchARKID, parentARKID, license, source, ownerInstitutionCode,
-        scientificName, genus, family, dataset)
-    if isinstance(new_multimedia, str):
-        raise HTTPException(status_code=400, detail=new_multimedia)
+    try:
+        created = await crud.create_multimedia(
+            db, file, batchARKID, parentARKID, license, source, ownerInstitutionCode,
+            scientificName, genus, family, dataset)
+    except ImageAnalysisError as error:
+        # a server side failure, not a problem of the uploaded image
+        raise HTTPException(status_code=503, detail=str(error))
+    if isinstance(created, str):
+        raise HTTPException(status_code=400, detail=created)
+    new_multimedia, analysis = created
+    if analysis is None:
+        if onDuplicate == schemas.DuplicateMode.reject:
+            raise HTTPException(status_code=409,
+                                detail="Image was uploaded before as ARK ID " + new_multimedia.ark_id)
+        return {
+            'status': 'duplicate',
+            'ark_id': new_multimedia.ark_id
+        }
     return {
         'status': 'success',
-        'ark_id': new_multimedia.ark_id
+        'ark_id': new_multimedia.ark_id,
+        'image': analysis
+    }
+
+
+# upload many images into one batch, from multiple files or a zip archive
+@router.post("/images/", tags=["Multimedia"])
+async def upload_images(batchARKID: str = Form(...),
+                        user: dict = Security(get_api_key),
+                        files: List[UploadFile] = File(None, description="image files"),
+                        archive: UploadFile = File(None, description="zip archive of image files"),
+                        manifest: UploadFile = File(None, description="csv with per file metadata"),
+                        scientificName: str = Form(None),
+                        genus: str = Form(None),
+                        family: str = Form(None),
+                        parentARKID: str = Form(None),
+                        license: str = Form(None),
+                        source: str = Form(None),
+                        ownerInstitutionCode: str = Form(None),
+                        dataset: schemas.DatasetName = Form(None),
+                        db: Session = Depends(get_db)):
+    '''
+        PRIVATE METHOD
+        upload many images into one batch, all records are inserted in one transaction
+        - param: files: Image Files (size < 20mb, image type：JPEG/JPG/PNG/BMP/GIF)
+        - param: archive: zip archive of image files, instead of files, file names must be unique across its folders
+        - param: manifest: csv with a filename column and optional scientificName, genus, family, parentARKID,
+          license, source, ownerInstitutionCode, dataset columns, overrides the form values per file
+        - param: batchARKID:
+        - param: parentARKID: default for all files
+        - param: license: default for all files
+        - param: source: default for all files
+        - param: ownerInstitutionCode: default for all files
+        - param: scientificName: default for all files
+        - param: genus: default for all files
+        - param: family: default for all files
+        - param: dataset: (segmentation/landmark/boundingbox) default for all files
+        - return: upload success/duplicate/failure of every file and the ark id of each stored image,
+          images that were uploaded before are not stored again and return the existing ark id
+    '''
+    if archive is not None:
+        try:
+            entries = await run_db(utils.zip_members, archive.file)
+        except (BadZipFile, LargeZipFile):
+            raise HTTPException(status_code=400, detail="Invalid zip archive")
+        except ValueError as error:
+            raise HTTPException(status_code=400, detail=str(error))
+    else:
+        entries = [(file.filename, lambda upload=file: upload.file) for file in files or []]
+    if len(entries) == 0:
+        raise HTTPException(status_code=400, detail="No image files uploaded.")
+    if len(entries) > bulk_upload_max_files:
+        raise HTTPException(status_code=400,
+                            detail="Too many files, at most %d files per upload." % bulk_upload_max_files)
+    file_manifest = {}
+    if manifest is not None:
+        try:
+            file_manifest = utils.read_manifest(await manifest.read())
+        except (UnicodeDecodeError, csv.Error) as error:
+            raise HTTPException(status_code=400, detail="Invalid manifest: " + str(error))
+    defaults = {
+        "parent_ark_id": parentARKID,
+        "image_license": license,
+        "image_source": source,
+        "image_institution_code": ownerInstitutionCode,
+        "scientific_name": scientificName,
+        "genus": genus,
+        "family": family,
+        "dataset": dataset,
+    }
+    results = await crud.create_multimedias(db, batchARKID, entries, defaults, file_manifest,
+                                            concurrency=bulk_upload_concurrency)
+    if isinstance(results, str):
+        raise HTTPException(status_code=400, detail=results)
+    uploaded = sum(1 for result in results if result['status'] == 'success')
+    duplicates = sum(1 for result in results if result['status'] == 'duplicate')
+    failed = len(results) - uploaded - duplicates
+    return {
+        'status': 'success' if failed == 0 else 'partial' if failed < len(results) else 'failure',
+        'batch_ark_id': batchARKID,
+        'uploaded': uploaded,
+        'duplicates': duplicates,
+        'failed': failed,
+        'results': results
     }
 
 
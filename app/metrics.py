@@ -0,0 +1,436 @@
+"""
+instrumentation in the Prometheus text format: request latency per route, requests in flight,
+database queries per request(counted by SQLAlchemy events into the request context) and export phase timings,
+timing spans of a single request(db, orm, serialize, csv, zip)
+"""
+import heapq
+import itertools
+import threading
+import time
+import configparser
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from starlette.routing import Match
+
+from app.database import pool_metrics
+
+config = configparser.ConfigParser()
+config.read('./config.ini')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+EXPORT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+# route label of requests that match no route, so unknown paths do not create new series
+UNMATCHED_ROUTE = "unmatched"
+# route label of queries outside of a request(export jobs, startup)
+BACKGROUND_ROUTE = "background"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    pairs.extend('%s="%s"' % pair for pair in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            samples = sorted(self._values.items())
+        for key, value in samples:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    # per label set: [count per bucket(not cumulative), sum, count]
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            sample = self._values.get(key)
+            if sample is None:
+                sample = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample[0][index] += 1
+                    break
+            sample[1] += value
+            sample[2] += 1
+
+    def render(self):
+        with self._lock:
+            samples = sorted((key, ([*value[0]], value[1], value[2])) for key, value in self._values.items())
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+        for key, (counts, total, count) in samples:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(
+                    self.labelnames, key, [('le', _format_value(float(bound)))]), cumulative))
+            labels = _format_labels(self.labelnames, key)
+            lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    # collector: a function returning rendered lines, called on every scrape(state that is read, not counted)
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    'http_requests_total', 'HTTP requests by route and status', ('method', 'route', 'status')))
+http_request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'HTTP request latency until the last body chunk is sent',
+    ('method', 'route')))
+http_requests_in_flight = registry.register(Gauge(
+    'http_requests_in_flight', 'HTTP requests being served', ('method', 'route')))
+db_queries = registry.register(Counter(
+    'db_queries_total', 'SQL statements executed', ('route',)))
+db_query_duration = registry.register(Counter(
+    'db_query_seconds_total', 'time spent executing SQL statements', ('route',)))
+request_db_queries = registry.register(Histogram(
+    'http_request_db_queries', 'SQL statements executed per request', ('route',), QUERY_COUNT_BUCKETS))
+request_db_duration = registry.register(Histogram(
+    'http_request_db_seconds', 'time spent executing SQL statements per request', ('route',)))
+export_phase_duration = registry.register(Histogram(
+    'export_phase_seconds', 'time spent per phase of a zip export: query(reading rows), csv/parquet(writing the '
+    'files), compress(zip compression)', ('format', 'phase'), EXPORT_BUCKETS))
+export_rows = registry.register(Counter(
+    'export_rows_total', 'rows written to export archives', ('format',)))
+
+
+class RequestStats:
+    """
+    per request counters, shared through a context variable by the handler, its worker threads
+    and the SQLAlchemy event hooks
+    spans: seconds per span name, exclusive of the nested spans and statements
+    capture_statements: number of the slowest statements kept with their parameters(for the slow request log)
+    """
+
+    def __init__(self, route, capture_statements=0):
+        self.route = route
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.spans = {}
+        self.capture_statements = capture_statements
+        self._statements = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def add_span(self, name, seconds):
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def record_query(self, seconds, statement, parameters, executemany):
+        with self._lock:
+            self.queries += 1
+            self.query_seconds += seconds
+            if self.capture_statements and not executemany:
+                item = (seconds, next(self._sequence), statement, parameters)
+                if len(self._statements) < self.capture_statements:
+                    heapq.heappush(self._statements, item)
+                elif seconds > self._statements[0][0]:
+                    heapq.heapreplace(self._statements, item)
+
+    # the slowest statements: [(seconds, statement, parameters)], slowest first
+    def slowest_statements(self):
+        with self._lock:
+            return [(seconds, statement, parameters) for seconds, _, statement, parameters in
+                    sorted(self._statements, reverse=True)]
+
+
+request_stats = ContextVar('request_stats', default=None)
+
+
+class SpanFrame:
+    def __init__(self):
+        self.nested = 0.0
+
+
+# innermost open span of the current context, statements and nested spans are subtracted from it
+current_span = ContextVar('current_span', default=None)
+
+
+# time a block(or a function, as a decorator) as a span of the current request, nothing is recorded
+# outside of a request
+@contextmanager
+def span(name):
+    stats = request_stats.get()
+    if stats is None:
+        yield
+        return
+    parent = current_span.get()
+    frame = SpanFrame()
+    token = current_span.set(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        current_span.reset(token)
+        stats.add_span(name, elapsed - frame.nested)
+        if parent is not None:
+            parent.nested += elapsed
+
+
+# time every next() of an iterable as a span
+def span_iter(iterable, name):
+    iterator = iter(iterable)
+    while True:
+        with span(name):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    stats = request_stats.get()
+    if stats is not None:
+        stats.record_query(elapsed, statement, parameters, executemany)
+        frame = current_span.get()
+        if frame is not None:
+            frame.nested += elapsed
+    route = stats.route if stats is not None else BACKGROUND_ROUTE
+    db_queries.inc(route=route)
+    db_query_duration.inc(elapsed, route=route)
+
+
+_instrumented = set()
+
+
+# count and time every statement executed on the engine
+def instrument_engine(engine):
+    if engine in _instrumented:
+        return
+    _instrumented.add(engine)
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+# route template of a request(/multimedia/{ARKID}), the path itself is not used as a label
+def route_name(router, scope):
+    partial = None
+    for route in router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, 'path', UNMATCHED_ROUTE)
+        if match == Match.PARTIAL and partial is None:
+            partial = getattr(route, 'path', UNMATCHED_ROUTE)
+    return partial or UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """
+    times each HTTP request from the first byte received until the last body chunk is sent,
+    streamed responses included, and records its database queries
+    """
+
+    def __init__(self, app, router):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        method = scope['method']
+        route = route_name(self.router, scope)
+        stats = RequestStats(route)
+        token = request_stats.set(stats)
+        status = []
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+            await send(message)
+
+        http_requests_in_flight.inc(method=method, route=route)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_request_duration.observe(time.perf_counter() - start, method=method, route=route)
+            http_requests_in_flight.dec(method=method, route=route)
+            http_requests.inc(method=method, route=route, status=status[0] if status else 500)
+            request_db_queries.observe(stats.queries, route=route)
+            request_db_duration.observe(stats.query_seconds, route=route)
+            request_stats.reset(token)
+
+
+# request span of an export phase, reading rows is covered by the statement timing(db)
+EXPORT_SPANS = {'csv': 'csv', 'parquet': 'parquet', 'compress': 'zip'}
+
+
+class ExportTimer:
+    """
+    exclusive time per phase of one export: every wrapped iterable adds the time spent in its next()
+    to its phase, minus the time of wrapped iterables it reads from, so the phases add up to the total
+    """
+
+    def __init__(self, export_format='csv'):
+        self.export_format = str(getattr(export_format, 'value', export_format))
+        self.phases = {}
+        self.rows = 0
+        self._stack = []
+
+    def wrap(self, iterable, phase, count_rows=False):
+        iterator = iter(iterable)
+        try:
+            while True:
+                self._stack.append(0.0)
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self._record(phase, start)
+                if count_rows:
+                    self.rows += len(item)
+                yield item
+        finally:
+            # an export that is not read to the end closes its row sources(server-side cursors) right away
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    def _record(self, phase, start):
+        elapsed = time.perf_counter() - start
+        nested = self._stack.pop()
+        self.phases[phase] = self.phases.get(phase, 0.0) + elapsed - nested
+        if self._stack:
+            self._stack[-1] += elapsed
+        # file writing and compression are spans of the request that streams the export
+        stats = request_stats.get()
+        if stats is not None and phase in EXPORT_SPANS:
+            stats.add_span(EXPORT_SPANS[phase], elapsed - nested)
+
+    # the whole archive(the zip file iterator): compression is the time not spent in the inner phases,
+    # the phase timings are recorded when it is completely read
+    def archive(self, zf):
+        yield from self.wrap(zf, 'compress')
+        for phase, seconds in self.phases.items():
+            export_phase_duration.observe(seconds, format=self.export_format, phase=phase)
+        export_rows.inc(self.rows, format=self.export_format)
+
+
+def _pool_lines():
+    metrics = pool_metrics()
+    gauges = [
+        ('db_pool_size', 'configured connection pool size', metrics['pool_size']),
+        ('db_pool_checked_out', 'connections checked out of the pool', metrics['checked_out']),
+        ('db_pool_checked_in', 'idle connections in the pool', metrics['checked_in']),
+        ('db_pool_overflow', 'overflow connections in use', metrics['overflow']),
+        ('db_pool_max_overflow', 'configured maximum overflow', metrics['max_overflow']),
+        ('db_pool_wait_seconds_max', 'longest wait for a connection', metrics['wait_seconds_max']),
+        ('db_pool_held_seconds_max', 'longest time a connection was checked out', metrics['held_seconds_max']),
+    ]
+    counters = [
+        ('db_pool_checkouts_total', 'connection checkouts', metrics['checkouts']),
+        ('db_pool_checkout_failures_total', 'connection checkouts that timed out', metrics['checkout_failures']),
+        ('db_pool_wait_seconds_total', 'time spent waiting for a connection', metrics['wait_seconds_total']),
+        ('db_pool_held_seconds_total', 'time connections were checked out', metrics['held_seconds_total']),
+        ('db_pool_connects_total', 'new database connections', metrics['connects']),
+        ('db_pool_invalidations_total', 'invalidated database connections', metrics['invalidations']),
+    ]
+    lines = []
+    for kind, samples in (('gauge', gauges), ('counter', counters)):
+        for name, documentation, value in samples:
+            if value is None:
+                continue
+            lines.extend(['# HELP %s %s' % (name, documentation), '# TYPE %s %s' % (name, kind),
+                          '%s %s' % (name, _format_value(value))])
+    return lines
+
+
+registry.add_collector(_pool_lines)
+
+metrics_enabled = config.getboolean('metrics', 'enabled', fallback=True)
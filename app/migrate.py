@@ -0,0 +1,148 @@
+"""
+schema migration of the existing database: missing tables, columns added to the models, the pg_trgm extension
+and the indexes of the models
+
+the data version row of the export cache and the triggers counting deletes on the export tables,
+and the content hash of the images stored before it was added
+
+run once per deploy, before the new workers start, with a role allowed to create extensions:
+    python -m app.migrate
+
+on postgresql the indexes are built with CREATE INDEX CONCURRENTLY, the tables stay writable while they are built
+"""
+import os
+
+from sqlalchemy import insert, inspect, select, text, update
+from sqlalchemy.schema import CreateIndex
+
+from app import model_text
+from app.crud import multimedia_file_path
+from app.database import engine
+from app.utils import file_content_hash
+
+
+# columns added to the models after their tables were created: (table, column)
+ADDED_COLUMNS = [
+    # sha256 of the stored file, unique index ix_multimeida_content_hash
+    ('multimeida', 'content_hash'),
+    # data version of the export cache
+    ('image_quality_metadata', 'modify_date'),
+]
+
+
+# nullable columns without a default, adding them does not rewrite the table
+def add_columns(connection, log=print):
+    inspector = inspect(connection)
+    for table_name, column_name in ADDED_COLUMNS:
+        if column_name in {column['name'] for column in inspector.get_columns(table_name)}:
+            continue
+        column = model_text.metadata.tables[table_name].columns[column_name]
+        log('column %s.%s' % (table_name, column_name))
+        connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (
+            table_name, column_name, column.type.compile(dialect=connection.dialect))))
+
+
+# tables of the export archives, a delete on them bumps data_version.deletes
+EXPORT_TABLES = ['batch', 'multimeida', 'extended_image_metadata', 'image_quality_metadata']
+
+
+# deleted rows leave no modify date behind, the triggers count the deletes for the export cache key
+def data_version_triggers(connection, log=print):
+    if connection.execute(select(model_text.DataVersion.id)).first() is None:
+        connection.execute(insert(model_text.DataVersion).values(id=1, deletes=0))
+    postgresql = connection.dialect.name == 'postgresql'
+    if postgresql:
+        connection.execute(text(
+            'CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$ '
+            'BEGIN UPDATE data_version SET deletes = deletes + 1 WHERE id = 1; RETURN NULL; END '
+            '$$ LANGUAGE plpgsql'))
+    for table_name in EXPORT_TABLES:
+        log('trigger %s_data_version' % table_name)
+        if postgresql:
+            # once per statement, a bulk delete takes the row lock of data_version once
+            connection.execute(text('DROP TRIGGER IF EXISTS %s_data_version ON %s' % (table_name, table_name)))
+            connection.execute(text(
+                'CREATE TRIGGER %s_data_version AFTER DELETE OR TRUNCATE ON %s '
+                'FOR EACH STATEMENT EXECUTE PROCEDURE bump_data_version()' % (table_name, table_name)))
+        else:
+            connection.execute(text(
+                'CREATE TRIGGER IF NOT EXISTS %s_data_version AFTER DELETE ON %s '
+                'BEGIN UPDATE data_version SET deletes = deletes + 1 WHERE id = 1; END' % (table_name, table_name)))
+
+
+# hash the stored files of multimedias without a content hash, batch_size rows per transaction, so images
+# stored before the content_hash column existed are recognized as duplicates on upload
+# rows whose file is missing, or whose content is already stored under another ark id, keep no hash
+def backfill_content_hashes(bind=engine, log=print, batch_size=500):
+    multimedia = model_text.Multimeida.__table__
+    last_ark_id = ''
+    hashed = 0
+    while True:
+        with bind.begin() as connection:
+            rows = connection.execute(
+                select(multimedia.c.ark_id, multimedia.c.batch_ark_id, multimedia.c.format)
+                .where(multimedia.c.content_hash.is_(None), multimedia.c.ark_id > last_ark_id)
+                .order_by(multimedia.c.ark_id).limit(batch_size)).all()
+            if len(rows) == 0:
+                break
+            last_ark_id = rows[-1].ark_id
+            # content hash: first ark id of the batch with that content
+            hashes = {}
+            for row in rows:
+                file_name = multimedia_file_path(row.batch_ark_id, row.ark_id, row.format)
+                if not os.path.exists(file_name):
+                    continue
+                hashes.setdefault(file_content_hash(file_name), row.ark_id)
+            stored = set(connection.execute(select(multimedia.c.content_hash)
+                                            .where(multimedia.c.content_hash.in_(list(hashes)))).scalars())
+            for content_hash, ark_id in hashes.items():
+                if content_hash in stored:
+                    log('content of %s is already stored under another ark id' % ark_id)
+                    continue
+                connection.execute(update(multimedia).where(multimedia.c.ark_id == ark_id)
+                                   .values(content_hash=content_hash))
+                hashed += 1
+    log('content hash of %d stored images' % hashed)
+
+
+# indexes a failed CREATE INDEX CONCURRENTLY left behind, they exist but are not used
+def invalid_indexes(connection):
+    return set(connection.execute(text(
+        'SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid'
+    )).scalars())
+
+
+def create_index(connection, index):
+    options = index.dialect_options['postgresql']
+    concurrently = options['concurrently']
+    options['concurrently'] = connection.dialect.name == 'postgresql'
+    try:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+    finally:
+        options['concurrently'] = concurrently
+
+
+def upgrade(bind=engine, log=print):
+    model_text.Base.metadata.create_all(bind=bind)
+    with bind.begin() as connection:
+        add_columns(connection, log)
+        data_version_triggers(connection, log)
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction
+    with bind.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        postgresql = connection.dialect.name == 'postgresql'
+        if postgresql:
+            connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        invalid = invalid_indexes(connection) if postgresql else set()
+        for table in model_text.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in invalid:
+                    log('dropping invalid index %s' % index.name)
+                    connection.execute(text('DROP INDEX CONCURRENTLY %s' % index.name))
+                log('index %s' % index.name)
+                create_index(connection, index)
+    # after the indexes, the lookups of existing hashes use ix_multimeida_content_hash
+    backfill_content_hashes(bind, log)
+
+
+if __name__ == '__main__':
+    upgrade()
@@ -1,8 +1,9 @@
 # coding: utf-8
-from sqlalchemy import BigInteger, Boolean, Column, ForeignKey, Integer, String, Time, DateTime
+from sqlalchemy import BigInteger, Boolean, Column, ForeignKey, Integer, String, Time, DateTime, Index
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
+import app.config as config
 
 Base = declarative_base()
 metadata = Base.metadata
@@ -10,6 +11,10 @@ metadata = Base.metadata
 
 class Batch(Base):
     __tablename__ = 'batch'
+    __table_args__ = (
+        # delta exports
+        Index('ix_batch_modify_date', 'modify_date'),
+    )
 
     ark_id = Column(String, primary_key=True)
     batch_name = Column(String)
@@ -35,6 +40,26 @@ class Batch(Base):
 
 class Multimeida(Base):
     __tablename__ = 'multimeida'
+    __table_args__ = (
+        Index('ix_multimeida_genus', 'genus'),
+        Index('ix_multimeida_family', 'family'),
+        Index('ix_multimeida_scientific_name', 'scientific_name'),
+        Index('ix_multimeida_dataset', 'dataset'),
+        Index('ix_multimeida_batch_ark_id', 'batch_ark_id'),
+        Index('ix_multimeida_parent_ark_id', 'parent_ark_id'),
+        Index('ix_multimeida_owner_institution_code', 'owner_institution_code'),
+        # delta exports
+        Index('ix_multimeida_modify_date', 'modify_date'),
+        # one multimedia per stored content
+        Index('ix_multimeida_content_hash', 'content_hash', unique=True),
+        # substring/prefix ILIKE filters
+        Index('ix_multimeida_genus_trgm', 'genus', postgresql_using='gin',
+              postgresql_ops={'genus': 'gin_trgm_ops'}),
+        Index('ix_multimeida_family_trgm', 'family', postgresql_using='gin',
+              postgresql_ops={'family': 'gin_trgm_ops'}),
+        Index('ix_multimeida_scientific_name_trgm', 'scientific_name', postgresql_using='gin',
+              postgresql_ops={'scientific_name': 'gin_trgm_ops'}),
+    )
 
     ark_id = Column(String, primary_key=True)
     parent_ark_id = Column(String, ForeignKey("multimeida.ark_id"), nullable=True)
@@ -52,6 +77,8 @@ class Multimeida(Base):
     genus = Column(String)
     family = Column(String)
     dataset = Column(String)
+    # sha256 of the stored file
+    content_hash = Column(String)
 
     # children = relationship("Multimeida")
     children = relationship("Multimeida", backref=backref("parent", remote_side=[ark_id]))
@@ -60,9 +87,21 @@ class Multimeida(Base):
     quality_metadata = relationship("ImageQualityMetadatum", back_populates="ark_IQ")
     batch = relationship("Batch")
 
+    # scaled down copies served by /multimedia/{ark_id}/{derivative}
+    @property
+    def thumbnail_url(self):
+        return config.API_URL + "/multimedia/" + self.ark_id + "/thumbnail"
+
+    @property
+    def preview_url(self):
+        return config.API_URL + "/multimedia/" + self.ark_id + "/preview"
+
 
 class Person(Base):
     __tablename__ = 'people'
+    __table_args__ = (
+        Index('ix_people_api_key', 'api_key'),
+    )
 
     people_id = Column(String, primary_key=True)
     email = Column(String)
@@ -79,6 +118,11 @@ class Person(Base):
 
 class ExtendedImageMetadatum(Base):
     __tablename__ = 'extended_image_metadata'
+    __table_args__ = (
+        Index('ix_extended_image_metadata_ark_id_height_width', 'ark_id', 'height', 'width'),
+        # delta exports
+        Index('ix_extended_image_metadata_metadata_date', 'metadata_date'),
+    )
 
     ext_image_metadata_id = Column(String, primary_key=True)
     ark_id = Column(ForeignKey('multimeida.ark_id'), nullable=False)
@@ -97,6 +141,11 @@ class ExtendedImageMetadatum(Base):
 
 class ImageQualityMetadatum(Base):
     __tablename__ = 'image_quality_metadata'
+    __table_args__ = (
+        Index('ix_image_quality_metadata_ark_id', 'ark_id'),
+        # data version of the export cache
+        Index('ix_image_quality_metadata_modify_date', 'modify_date'),
+    )
 
     iq_metadata_id = Column(String, primary_key=True)
     ark_id = Column(ForeignKey('multimeida.ark_id'), nullable=False)
@@ -127,6 +176,16 @@ class ImageQualityMetadatum(Base):
     owner_institution_code = Column(String)
     create_date = Column(Time(True))
     metadata_date = Column(Time(True))
+    modify_date = Column(DateTime(True), default=datetime.utcnow, onupdate=datetime.utcnow)
 
     ark_IQ = relationship('Multimeida', back_populates="quality_metadata")
     creator = relationship('Person')
+
+
+# data version of the export cache, one row(id 1), deletes counts the statements deleting rows of the export tables
+# and is bumped by the triggers app.migrate creates, inserts and updates move the modify dates instead
+class DataVersion(Base):
+    __tablename__ = 'data_version'
+
+    id = Column(Integer, primary_key=True)
+    deletes = Column(BigInteger, nullable=False, default=0)
@@ -0,0 +1,110 @@
+"""
+parquet export: typed columnar files written row group by row group while the rows are streamed
+"""
+import configparser
+from datetime import date, datetime, timezone
+
+from sqlalchemy import BigInteger, Boolean, Date, DateTime, Float, Integer, Numeric, Time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pyarrow = None
+
+config = configparser.ConfigParser()
+config.read('./config.ini')
+
+row_group_size = config.getint('parquet', 'row_group_size', fallback=65536)
+compression = config.get('parquet', 'compression', fallback='zstd')
+
+
+# arrow type of a database column type, anything unknown is kept as text
+def arrow_type(column_type):
+    if isinstance(column_type, Boolean):
+        return pyarrow.bool_()
+    if isinstance(column_type, (BigInteger, Integer)):
+        return pyarrow.int64()
+    if isinstance(column_type, DateTime):
+        return pyarrow.timestamp('us', tz='UTC' if column_type.timezone else None)
+    if isinstance(column_type, Date):
+        return pyarrow.date32()
+    if isinstance(column_type, Time):
+        # arrow times carry no offset, times with a time zone are converted to UTC(utc_time) before they are written
+        return pyarrow.time64('us')
+    if isinstance(column_type, (Float, Numeric)):
+        return pyarrow.float64()
+    return pyarrow.string()
+
+
+# schema of a parquet file: field names(the csv header) with the types of the selected columns
+def arrow_schema(names, columns):
+    return pyarrow.schema([pyarrow.field(name, arrow_type(column.type)) for name, column in zip(names, columns)])
+
+
+class ChunkSink:
+    """
+    file-like target of the parquet writer, written bytes are collected until they are taken
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+# UTC time of a time with a time zone, times without one are returned as they are
+def utc_time(value):
+    if value is None or value.utcoffset() is None:
+        return value
+    # any date, only the time of day is kept
+    return datetime.combine(date(2000, 1, 1), value).astimezone(timezone.utc).time()
+
+
+def write_row_group(writer, schema, rows):
+    columns = list(zip(*rows))
+    arrays = []
+    for values, field in zip(columns, schema):
+        if pyarrow.types.is_time(field.type):
+            values = [utc_time(value) for value in values]
+        arrays.append(pyarrow.array(values, type=field.type))
+    writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+
+# yield the parquet file as one chunk per row group of row_group_size rows, the footer comes last
+def parquet_generator(row_batches, schema, group_size=None):
+    group_size = group_size or row_group_size
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression=compression)
+    try:
+        rows = []
+        for batch in row_batches:
+            rows.extend(batch)
+            if len(rows) >= group_size:
+                write_row_group(writer, schema, rows[:group_size])
+                rows = rows[group_size:]
+                yield sink.take()
+        if rows:
+            write_row_group(writer, schema, rows)
+    finally:
+        writer.close()
+    yield sink.take()
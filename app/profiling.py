@@ -0,0 +1,156 @@
+"""
+per request diagnostics: a Server-Timing header with the spans of the request(db, orm, serialize, csv, zip)
+and a slow request log with the slowest statements, optionally with their EXPLAIN ANALYZE plan
+"""
+import logging
+import time
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.datastructures import MutableHeaders
+
+from app.metrics import RequestStats, request_stats, route_name
+
+config = configparser.ConfigParser()
+config.read('./config.ini')
+
+logger = logging.getLogger(__name__)
+
+# Server-Timing order of the spans, other spans follow in name order
+SPAN_ORDER = ('db', 'orm', 'serialize', 'csv', 'parquet', 'zip')
+
+
+# Server-Timing header value, durations in milliseconds
+def server_timing(stats, total_seconds):
+    spans = dict(stats.spans)
+    spans['db'] = stats.query_seconds
+    names = [name for name in SPAN_ORDER if spans.get(name)] + sorted(set(spans) - set(SPAN_ORDER))
+    entries = []
+    for name in names:
+        entry = '%s;dur=%.3f' % (name, spans[name] * 1000)
+        if name == 'db':
+            entry = 'db;desc="%d queries";dur=%.3f' % (stats.queries, spans[name] * 1000)
+        entries.append(entry)
+    entries.append('total;dur=%.3f' % (total_seconds * 1000))
+    return ', '.join(entries)
+
+
+class SlowRequestLog:
+    """
+    logs requests slower than threshold seconds with their spans and slowest statements,
+    with explain on, SELECT statements slower than explain_threshold are run again under EXPLAIN ANALYZE
+    (in a rolled back transaction on a single background thread) and their plan is logged
+    """
+
+    def __init__(self, engine, threshold=2.0, max_statements=5, explain=False, explain_threshold=0.5,
+                 explain_timeout=30.0):
+        self.engine = engine
+        self.threshold = threshold
+        self.max_statements = max_statements
+        self.explain = explain
+        self.explain_threshold = explain_threshold
+        self.explain_timeout = explain_timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain") if explain else None
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def report(self, scope, status, seconds, stats):
+        if not self.enabled or seconds < self.threshold:
+            return
+        query_string = scope.get('query_string', b'').decode('latin-1')
+        statements = stats.slowest_statements()
+        lines = ['slow request: %s %s%s status=%s %.1f ms, %d queries, %s' % (
+            scope['method'], scope['path'], '?' + query_string if query_string else '', status,
+            seconds * 1000, stats.queries, server_timing(stats, seconds))]
+        # parameters are not logged, the query string shows the filters
+        for statement_seconds, statement, _ in statements:
+            lines.append('  %.1f ms: %s' % (statement_seconds * 1000, ' '.join(statement.split())))
+        logger.warning('\n'.join(lines))
+        if self.explain:
+            for statement_seconds, statement, parameters in statements:
+                if statement_seconds >= self.explain_threshold and is_select(statement):
+                    self._executor.submit(self._explain, statement, parameters, statement_seconds)
+
+    def _explain(self, statement, parameters, statement_seconds):
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if self.engine.dialect.name == 'postgresql':
+                cursor.execute('SET LOCAL statement_timeout = %d' % int(self.explain_timeout * 1000))
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + statement, parameters)
+            elif self.engine.dialect.name == 'sqlite':
+                cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            else:
+                return
+            plan = '\n'.join('    ' + ' '.join(str(column) for column in row) for row in cursor.fetchall())
+            logger.warning('explain of a %.1f ms statement: %s\n%s', statement_seconds * 1000,
+                           ' '.join(statement.split()), plan)
+        except Exception as error:
+            logger.warning('explain failed: %s', error)
+        finally:
+            # EXPLAIN ANALYZE runs the statement, nothing it may have changed is kept
+            connection.rollback()
+            connection.close()
+
+
+def is_select(statement):
+    return statement.lstrip().upper().startswith(('SELECT', 'WITH'))
+
+
+class ServerTimingMiddleware:
+    """
+    adds the Server-Timing header to every response and reports slow requests to the slow request log,
+    the header holds the spans until the response starts, spans of streamed bodies(csv, zip) only reach the log
+    """
+
+    def __init__(self, app, router, slow_log, header=True):
+        self.app = app
+        self.router = router
+        self.slow_log = slow_log
+        self.header = header
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        stats = request_stats.get()
+        token = None
+        if stats is None:
+            stats = RequestStats(route_name(self.router, scope))
+            token = request_stats.set(stats)
+        if self.slow_log.enabled:
+            stats.capture_statements = self.slow_log.max_statements
+        start = time.perf_counter()
+        status = []
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+                if self.header:
+                    headers = MutableHeaders(raw=message['headers'])
+                    headers.append('Server-Timing', server_timing(stats, time.perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.slow_log.report(scope, status[0] if status else 500, time.perf_counter() - start, stats)
+            if token is not None:
+                request_stats.reset(token)
+
+
+def profiling_options():
+    return {
+        'header': config.getboolean('profiling', 'server_timing', fallback=True),
+    }
+
+
+def slow_request_log(engine):
+    return SlowRequestLog(engine,
+                          threshold=config.getfloat('profiling', 'slow_request_seconds', fallback=2.0),
+                          max_statements=config.getint('profiling', 'slow_statements', fallback=5),
+                          explain=config.getboolean('profiling', 'explain', fallback=False),
+                          explain_threshold=config.getfloat('profiling', 'explain_seconds', fallback=0.5),
+                          explain_timeout=config.getfloat('profiling', 'explain_timeout', fallback=30.0))
@@ -56,6 +56,33 @@ class Pipeline(str, Enum):
     lm = "landmark"
 
 
+class DerivativeName(str, Enum):
+    thumbnail = "thumbnail"
+    preview = "preview"
+
+
+class DuplicateMode(str, Enum):
+    link = "link"
+    reject = "reject"
+
+
+class ResponseFormat(str, Enum):
+    zip = "zip"
+    json = "json"
+    ndjson = "ndjson"
+
+
+class ExportFormat(str, Enum):
+    csv = "csv"
+    parquet = "parquet"
+
+
+class MatchMode(str, Enum):
+    substring = "substring"
+    prefix = "prefix"
+    exact = "exact"
+
+
 class DatasetItem(BaseModel):
     name: DatasetName = None
 
@@ -162,6 +189,8 @@ class Multimedia(MultimediaBase):
     ark_id: str
     parent_ark_id: Optional[str]
     batch_id: Optional[str]
+    thumbnail_url: Optional[str]
+    preview_url: Optional[str]
     children: List['Multimedia'] = []
 
     class Config:
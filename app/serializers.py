@@ -0,0 +1,136 @@
+"""
+fast JSON responses: serializers compiled from the pydantic schemas read the ORM objects directly and the result
+is encoded with orjson, the bytes are the same as the response_model validation and JSONResponse would produce
+"""
+import json
+from datetime import datetime
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON
+
+from app.metrics import span
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+
+class SchemaFallback(Exception):
+    """
+    a value the compiled serializer does not reproduce exactly(coercion or validation by pydantic),
+    the response is built through the schema instead
+    """
+
+
+def _fallback(name):
+    raise SchemaFallback(name)
+
+
+# source of the value conversion of one scalar field: an expression over `v`,
+# values that pydantic would coerce or reject go to the schema path
+SCALAR_CHECKS = {
+    str: "v if type(v) is str else _fallback({name!r})",
+    int: "v if type(v) is int else _fallback({name!r})",
+    bool: "v if type(v) is bool else _fallback({name!r})",
+    datetime: "v.isoformat() if type(v) is datetime else _fallback({name!r})",
+}
+
+_serializers = {}
+
+
+# serializer of a schema: obj -> dict with the keys and values of jsonable_encoder(schema.from_orm(obj)),
+# generated once per schema, nested and recursive schemas are compiled on the way
+def compile_serializer(model):
+    if model in _serializers:
+        return _serializers[model]
+    function_name = "serialize_" + model.__name__
+    namespace = {"datetime": datetime, "_fallback": _fallback}
+    # recursive schemas reference their serializer through the namespace before it is defined
+    _serializers[model] = lambda obj: namespace[function_name](obj)
+    lines = ["def %s(obj):" % function_name, "    return {"]
+    try:
+        for index, field in enumerate(model.__fields__.values()):
+            lines.append(_field_source(field, index, namespace))
+    except TypeError:
+        del _serializers[model]
+        raise
+    lines.append("    }")
+    exec("\n".join(lines), namespace)
+    _serializers[model] = namespace[function_name]
+    return _serializers[model]
+
+
+def _field_source(field, index, namespace):
+    name = field.alias
+    none_check = "None" if field.allow_none else "_fallback(%r)" % name
+    if isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+        nested = "nested_%d" % index
+        namespace[nested] = compile_serializer(field.type_)
+        if field.shape == SHAPE_LIST:
+            value = "[%s(item) for item in v]" % nested
+        elif field.shape == SHAPE_SINGLETON:
+            value = "%s(v)" % nested
+        else:
+            raise TypeError("unsupported field shape: %s" % name)
+    elif field.shape == SHAPE_SINGLETON and field.type_ in SCALAR_CHECKS:
+        value = SCALAR_CHECKS[field.type_].format(name=name)
+    else:
+        raise TypeError("unsupported field type: %s" % name)
+    attribute = "obj." + name if name.isidentifier() else "getattr(obj, %r)" % name
+    return "        %r: %s if (v := %s) is None else %s," % (name, none_check, attribute, value)
+
+
+# utf-8 json as rendered by fastapi's JSONResponse
+def render(content):
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
+
+
+# the same bytes as render() for serialized content, orjson when it is installed
+def encode(content):
+    if orjson is not None:
+        return orjson.dumps(content)
+    return render(content)
+
+
+# json of ORM objects(one object or a list) in the shape of a response_model schema
+@span('serialize')
+def dumps(model, content):
+    serializer = compile_serializer(model)
+    try:
+        if isinstance(content, list):
+            return encode([serializer(obj) for obj in content])
+        return encode(serializer(content))
+    except SchemaFallback:
+        if isinstance(content, list):
+            validated = [model.from_orm(obj) for obj in content]
+        else:
+            validated = model.from_orm(content)
+        return render(jsonable_encoder(validated))
+
+
+# newline delimited json of ORM objects, one line per object
+@span('serialize')
+def dumps_lines(model, content):
+    serializer = compile_serializer(model)
+    lines = []
+    for obj in content:
+        try:
+            lines.append(encode(serializer(obj)))
+        except SchemaFallback:
+            lines.append(render(jsonable_encoder(model.from_orm(obj))))
+    lines.append(b"")
+    return b"\n".join(lines)
+
+
+def json_response(model, content, headers=None):
+    return Response(content=dumps(model, content), media_type="application/json", headers=headers)
+
+
+# ndjson streamed while the chunks of ORM objects are read
+def ndjson_response(model, chunks, headers=None):
+    return StreamingResponse((dumps_lines(model, chunk) for chunk in chunks), media_type="application/x-ndjson",
+                             headers=headers)
@@ -2,49 +2,79 @@
 CURD parts
 !!!This section of code needs to be refactored and remove redundant parts.
 """
+import base64
+import csv
+import io
 import os
 import secrets
 import string
 import hashlib
+import zipfile
 import app.config as config
+from app.arks import ark_pool
+from app.parquet import arrow_schema, parquet_generator
 import zipstream as zipstream
 
-from noid.pynoid import *
 from jinja2 import FileSystemLoader, Environment
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import partial
 from fastapi import UploadFile
 
 
-def zipfile_generator(results, batch_results, params):
+# build the export archive lazily, nothing is compressed until the returned ZipFile is iterated
+# results: dict of per-csv row sources({'multimedia':..., 'extended':..., 'quality':...}), each an iterable of
+# lists of row tuples which are written into the archive batch by batch
+# batch_results: batch rows
+# export_format: 'csv' or 'parquet', parquet files are typed from columns(the export columns per table)
+# timer: metrics.ExportTimer recording the time spent reading rows and writing the files
+def zipfile_builder(results, batch_results, params, export_format='csv', columns=None, timer=None):
     dataset_ark_id_results = minter(config.ARK_DATASETS)
     dataset_ark_id = dataset_ark_id_results[2]
     current_date = datetime.now().strftime("%Y-%m-%d")
     zf = zipstream.ZipFile(compression=zipstream.ZIP_DEFLATED)
     file_list = ["meta.xml", "rdf.owl"]
+    if export_format == 'parquet':
+        # the Darwin Core archive descriptor(meta.xml) describes the csv files, parquet archives go without it
+        file_list = ["rdf.owl"]
     for file in file_list:
         basicFilesSourcePath = os.path.join(config.ZIPFILES_PATH, file).replace("\\", "/");
         basicFilesTargetPath = os.path.join('Fish-AIR/Tulane/' + dataset_ark_id + '/', file).replace("\\", "/")
         zf.write(basicFilesSourcePath, basicFilesTargetPath, zipstream.ZIP_DEFLATED)
 
-    # multimedia.csv
-    multimedia_csv, multimedia_count = csv_generator(results, type="multimedia")
+    if timer is not None:
+        results = {table: timer.wrap(row_batches, 'query', count_rows=True) for table, row_batches in results.items()}
+    file_phase = partial(timed, timer, 'parquet' if export_format == 'parquet' else 'csv')
 
-    # extended md.csv
-    extended_metadata_image_csv, extend_data_count = csv_generator(results, type="extended")
+    if export_format == 'parquet':
+        # parquet files are compressed per column already, they are stored as they are
+        for table in ('multimedia', 'extended', 'quality', 'batch'):
+            row_batches = [batch_results] if table == 'batch' else results.get(table)
+            if row_batches is None:
+                continue
+            file_stem, header = EXPORT_FILES[table]
+            zf.write_iter(os.path.join('Fish-AIR/Tulane/' + dataset_ark_id + '/', file_stem + ".parquet"),
+                          file_phase(parquet_generator(row_batches, arrow_schema(header, columns[table]))),
+                          zipstream.ZIP_STORED)
+        citation_info = batch_citation_generator(batch_results)[1]
+    else:
+        # multimedia.csv
+        multimedia_csv = file_phase(csv_generator(results['multimedia'], MULTIMEDIA_CSV_HEADER))
 
-    # IQ.csv
-    quality_metadata_image_csv, quality_data_count = csv_generator(results, type="quality")
-    batch_csv, citation_info = batch_citation_generator(batch_results)
-    metadata_xml = metadata_generator(dataset_ark_id, params, current_date)
-    zf.write_iter(os.path.join('Fish-AIR/Tulane/' + dataset_ark_id + '/', "multimedia.csv"), iterable(multimedia_csv))
-    zf.write_iter(os.path.join('Fish-AIR/Tulane/' + dataset_ark_id + '/', "extendedImageMetadata.csv"),
-                  iterable(extended_metadata_image_csv))
-    if quality_data_count > 0:
-        zf.write_iter(os.path.join('Fish-AIR/Tulane/' + dataset_ark_id + '/', "imageQualityMetadata.csv"),
-                      iterable(quality_metadata_image_csv))
+        # extended md.csv
+        extended_metadata_image_csv = file_phase(csv_generator(results['extended'], EXTENDED_CSV_HEADER))
+        batch_csv, citation_info = batch_citation_generator(batch_results)
+        zf.write_iter(os.path.join('Fish-AIR/Tulane/' + dataset_ark_id + '/', "multimedia.csv"), multimedia_csv)
+        zf.write_iter(os.path.join('Fish-AIR/Tulane/' + dataset_ark_id + '/', "extendedImageMetadata.csv"),
+                      extended_metadata_image_csv)
 
-    # batch
-    zf.write_iter(os.path.join('Fish-AIR/Tulane/' + dataset_ark_id + '/', "batch.csv"), iterable(batch_csv))
+        # IQ.csv
+        if 'quality' in results:
+            zf.write_iter(os.path.join('Fish-AIR/Tulane/' + dataset_ark_id + '/', "imageQualityMetadata.csv"),
+                          file_phase(csv_generator(results['quality'], QUALITY_CSV_HEADER)))
+
+        # batch
+        zf.write_iter(os.path.join('Fish-AIR/Tulane/' + dataset_ark_id + '/', "batch.csv"), iterable(batch_csv))
+    metadata_xml = metadata_generator(dataset_ark_id, params, current_date)
 
     # citations
     zf.write_iter(os.path.join('Fish-AIR/Tulane/' + dataset_ark_id + '/', "citations.txt"), iterable(citation_info))
@@ -53,83 +83,51 @@ def zipfile_generator(results, batch_results, params):
     zf.write_iter(os.path.join('Fish-AIR/Tulane/' + dataset_ark_id + '/', "metadata.xml"), iterable(metadata_xml))
 
     zf.filename = "Fish-AIR_" + dataset_ark_id + ".zip"
-    with open(os.path.join(zf.filename), 'wb') as f:
-        for data in zf:
-            f.write(data)
-    return os.path.join(zf.filename), zf.filename
-
-
-def csv_generator(results, type):
-    data_count = 0
-    if type == 'multimedia':
-        csv_header = "ARKID,parentArkId,accessURI,createDate,modifyDate,fileNameAsDelivered,format,scientificName," \
-                     "genus,family,batchName,license,source,ownerInstitutionCode\n "
-        csv_body = ""
-        for record in results:
-            recstring = str(record.ark_id) + ',' + str(record.parent_ark_id) + ',' + str(
-                record.path) + ',' + str(record.create_date) + ',' + str(record.modify_date) + ',\"' + str(
-                record.filename_as_delivered) + '\",' + str(record.format) + ',\"' + \
-                        str(record.scientific_name) + '\",' + str(record.genus) + ',' + str(record.family) + ',' + str(
-                record.batch_id) + ',' + str(record.license) + ',' + str(
-                record.source) + ',' + str(record.owner_institution_code) + '\n'
-            csv_body += recstring
-            data_count = data_count + 1
-        return csv_header + csv_body, data_count
-    if type == 'extended':
-        csv_header = "ARKID,fileNameAsDelivered,format,createDate,metadataDate,size,width,height,license,publisher," \
-                     "ownerInstitutionCode\n "
-        csv_body = ""
-        for record in results:
-            recstring = str(record.extended_metadata[0].ark_id) + ',\"' + str(
-                record.filename_as_delivered) + '\",' + str(
-                record.format) + ',' + str(record.extended_metadata[0].create_date) + ',' + str(
-                record.extended_metadata[0].metadata_date) + ',' + str(record.extended_metadata[0].size) + ',' + \
-                        str(record.extended_metadata[0].width) + ',' + str(
-                record.extended_metadata[0].height) + ',' + str(record.extended_metadata[0].license) + ',' + str(
-                record.extended_metadata[0].publisher) + ',' + str(
-                record.extended_metadata[0].owner_institution_code) + '\n'
-            csv_body += recstring
-            data_count = data_count + 1
-        return csv_header + csv_body, data_count
-    if type == 'quality':
-        csv_header = "ARKID,license,publisher,ownerInstitutionCode,createDate,metadataDate,specimenQuantity," \
-                     "containsScaleBar,containsLabel,accessionNumberValidity,containsBarcode,containsColorBar," \
-                     "nonSpecimenObjects,partsOverlapping,specimenAngle,specimenView,specimenCurved,partsMissing," \
-                     "allPartsVisible,partsFolded,brightness,uniformBackground,onFocus,colorIssue,quality," \
-                     "resourceCreationTechnique\n"
-        csv_body = ""
-        for record in results:
-            if len(record.quality_metadata) > 0:
-                recstring = str(record.quality_metadata[0].ark_id) \
-                            + ',' + str(record.quality_metadata[0].license) \
-                            + ',' + str(record.quality_metadata[0].publisher) \
-                            + ',' + str(record.quality_metadata[0].owner_institution_code) \
-                            + ',' + str(record.quality_metadata[0].create_date) \
-                            + ',' + str(record.quality_metadata[0].metadata_date) \
-                            + ',' + str(record.quality_metadata[0].specimen_quantity) \
-                            + ',' + str(record.quality_metadata[0].contains_scalebar) \
-                            + ',' + str(record.quality_metadata[0].contains_label) \
-                            + ',' + str(record.quality_metadata[0].accession_number_validity) \
-                            + ',' + str(record.quality_metadata[0].contains_barcode) \
-                            + ',' + str(record.quality_metadata[0].contains_colorbar) \
-                            + ',\"' + str(record.quality_metadata[0].non_specimen_objects) + '\"' \
-                            + ',' + str(record.quality_metadata[0].parts_overlapping) \
-                            + ',' + str(record.quality_metadata[0].specimen_angle) \
-                            + ',' + str(record.quality_metadata[0].specimen_view) \
-                            + ',' + str(record.quality_metadata[0].specimen_curved) \
-                            + ',' + str(record.quality_metadata[0].parts_missing) \
-                            + ',' + str(record.quality_metadata[0].all_parts_visible) \
-                            + ',' + str(record.quality_metadata[0].parts_folded) \
-                            + ',' + str(record.quality_metadata[0].brightness) \
-                            + ',' + str(record.quality_metadata[0].uniform_background) \
-                            + ',' + str(record.quality_metadata[0].on_focus) \
-                            + ',\"' + str(record.quality_metadata[0].color_issue) + "\"" \
-                            + ',' + str(record.quality_metadata[0].quality) \
-                            + ',' + str(record.quality_metadata[0].data_capture_method) \
-                            + '\n'
-                csv_body += recstring
-                data_count = data_count + 1
-        return csv_header + csv_body, data_count
+    return zf
+
+
+MULTIMEDIA_CSV_HEADER = ["ARKID", "parentArkId", "accessURI", "createDate", "modifyDate", "fileNameAsDelivered",
+                         "format", "scientificName", "genus", "family", "batchName", "license", "source",
+                         "ownerInstitutionCode"]
+EXTENDED_CSV_HEADER = ["ARKID", "fileNameAsDelivered", "format", "createDate", "metadataDate", "size", "width",
+                       "height", "license", "publisher", "ownerInstitutionCode"]
+QUALITY_CSV_HEADER = ["ARKID", "license", "publisher", "ownerInstitutionCode", "createDate", "metadataDate",
+                      "specimenQuantity", "containsScaleBar", "containsLabel", "accessionNumberValidity",
+                      "containsBarcode", "containsColorBar", "nonSpecimenObjects", "partsOverlapping",
+                      "specimenAngle", "specimenView", "specimenCurved", "partsMissing", "allPartsVisible",
+                      "partsFolded", "brightness", "uniformBackground", "onFocus", "colorIssue", "quality",
+                      "resourceCreationTechnique"]
+BATCH_CSV_HEADER = ["ARKID", "batchName", "institutionCode", "pipeline", "createDate", "modifyDate", "creator",
+                    "creatorComments", "contactor", "labCode", "projectName", "codeRepository", "datasetName",
+                    "bibliographicCitation", "URL"]
+
+
+# file name(without extension) and header of each export table
+EXPORT_FILES = {
+    'multimedia': ("multimedia", MULTIMEDIA_CSV_HEADER),
+    'extended': ("extendedImageMetadata", EXTENDED_CSV_HEADER),
+    'quality': ("imageQualityMetadata", QUALITY_CSV_HEADER),
+    'batch': ("batch", BATCH_CSV_HEADER),
+}
+
+
+# yield the csv as one encoded chunk per batch of rows, fields are quoted by the csv module where needed
+def csv_generator(row_batches, csv_header):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(csv_header)
+    for rows in row_batches:
+        writer.writerows(rows)
+        yield str.encode(buffer.getvalue())
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell() > 0:
+        yield str.encode(buffer.getvalue())
+
+
+# chunks of an archive file, timed as `phase` when an ExportTimer is given
+def timed(timer, phase, chunks):
+    return chunks if timer is None else timer.wrap(chunks, phase)
 
 
 def batch_citation_generator(results):
@@ -139,30 +137,14 @@ def batch_citation_generator(results):
     citation_body = ""
 
     # batch
-    csv_header = "ARKID,batchName,institutionCode,pipeline,createDate,modifyDate,creator,creatorComments,contactor," \
-                 "labCode,projectName,codeRepository,datasetName,bibliographicCitation,URL\n "
-    csv_body = ""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(BATCH_CSV_HEADER)
+    writer.writerows(results)
     for record in results:
-        recstring = str(record.ark_id) \
-                    + ',' + str(record.batch_name) \
-                    + ',' + str(record.institution_code) \
-                    + ',' + str(record.pipeline) \
-                    + ',' + str(record.create_date) \
-                    + ',' + str(record.modify_date) \
-                    + ',' + str(record.creator) \
-                    + ',' + str(record.creator_comment) \
-                    + ',' + str(record.contactor) \
-                    + ',' + str(record.lab_code) \
-                    + ',' + str(record.project_name) \
-                    + ',' + str(record.code_repository) \
-                    + ',' + str(record.dataset_name) \
-                    + ',' + str(record.bibliographic_citation) \
-                    + ',' + str(record.url) \
-                    + '\n'
-        csv_body += recstring
         if record.bibliographic_citation is not None:
             citation_body += record.bibliographic_citation + '\n'
-    batch_content = csv_header + csv_body
+    batch_content = buffer.getvalue()
     citation_content = citation_firstline + citation_body
     return batch_content, citation_content
 
@@ -183,32 +165,51 @@ def iterable(csv):
 # ark id generator
 # TU organization id : 89609
 def minter(ark_type):
-    template = 'bat.eeddeedek'
-    if ark_type == config.ARK_BATCH:
-        template = 'bat.eeddeedek'
-    elif ark_type == config.ARK_DATASETS:
-        template = 'dts.eeddeedek'
-    elif ark_type == config.ARK_MULTIMEDIA:
-        template = 'eeddeede'
-    ark_id = mint(template=template, scheme='ark:/', naa='89609')
-    ark_obj = ark_id.split("/")
-
-    return ark_obj
+    return ark_pool.take(ark_type)
 
 
 # validate upload file
 def uploadFileValidation(file: UploadFile):
     # content_type = file.content_type.split("/")
-    format = file.filename.split(".")[1]
-    content_size = len(file.file.read())
+    # size from the end position of the spooled file, the content is not read
+    file.file.seek(0, os.SEEK_END)
+    content_size = file.file.tell()
     # turn the file pointer from the end of the file to the start of the file
     file.file.seek(0)
+    return imageFileValidation(file.filename, content_size)
+
+
+# file extension(format) of an uploaded file
+def file_format(filename):
+    return filename.rsplit(".", 1)[-1]
+
+
+MAX_IMAGE_SIZE = 20 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+# content hash of a stored image(multimeida.content_hash): sha256 of the file
+def content_hasher():
+    return hashlib.sha256()
+
+
+def file_content_hash(file_name, chunk_size=UPLOAD_CHUNK_SIZE):
+    file_hash = content_hasher()
+    with open(file_name, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# validate image file name and size
+def imageFileValidation(filename, content_size):
+    format = file_format(filename)
     validate_flag = False
     validate_error_msg = 'Uploaded file is not a valid image: '
     if format not in ['png', 'jpeg', 'jpg', 'bmp', 'gif']:
         validate_error_msg = validate_error_msg + 'Only JPEG/JPG/PNG/BMP/GIF files are allowed. '
         validate_flag = True
-    if content_size > 20 * 1024 * 1024:
+    if content_size > MAX_IMAGE_SIZE:
         validate_error_msg = validate_error_msg + 'Image size should be within 20 MB '
         validate_flag = True
     if validate_flag:
@@ -217,15 +218,97 @@ def uploadFileValidation(file: UploadFile):
         return ''
 
 
+# copy an image from a binary file object to file_name in one pass, the size and content hash(sha256) are
+# collected from the chunks on the way and the copy stops as soon as the size limit is exceeded,
+# the image itself is decoded and verified afterwards by the image analysis processes
+# returns {'size', 'content_hash'} or an error message
+def store_image(source, filename, file_name, chunk_size=UPLOAD_CHUNK_SIZE):
+    validate_error = imageFileValidation(filename, 0)
+    if validate_error != '':
+        return validate_error
+    os.makedirs(file_name.parent, exist_ok=True)
+    temp_name = file_name.parent / ('.' + file_name.name + '.part')
+    file_hash = content_hasher()
+    size = 0
+    try:
+        with open(temp_name, 'wb') as f:
+            while chunk := source.read(chunk_size):
+                size += len(chunk)
+                if size > MAX_IMAGE_SIZE:
+                    return imageFileValidation(filename, size)
+                file_hash.update(chunk)
+                f.write(chunk)
+        os.replace(temp_name, file_name)
+    finally:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+    return {'size': size, 'content_hash': file_hash.hexdigest()}
+
+
+# manifest of a bulk upload: csv with a filename column and optional scientificName, genus, family,
+# parentARKID, license, source, ownerInstitutionCode, dataset columns, returns {filename: {field: value}}
+MANIFEST_COLUMNS = {
+    "scientificName": "scientific_name",
+    "genus": "genus",
+    "family": "family",
+    "parentARKID": "parent_ark_id",
+    "license": "image_license",
+    "source": "image_source",
+    "ownerInstitutionCode": "image_institution_code",
+    "dataset": "dataset",
+}
+
+
+def read_manifest(content: bytes):
+    manifest = {}
+    for row in csv.DictReader(io.StringIO(content.decode('utf-8-sig'))):
+        filename = (row.get('filename') or '').strip()
+        if filename == '':
+            continue
+        manifest[filename] = {field: row[column] for column, field in MANIFEST_COLUMNS.items()
+                              if row.get(column) not in (None, '')}
+    return manifest
+
+
+# image files in a zip archive: [(filename, open function)], folders inside the archive are ignored
+# the manifest matches files by name, a name found in more than one folder raises ValueError
+def zip_members(archive_file):
+    archive = zipfile.ZipFile(archive_file)
+    members = [(os.path.basename(info.filename), partial(archive.open, info))
+               for info in archive.infolist()
+               if not info.is_dir() and not os.path.basename(info.filename).startswith('.')]
+    names = [name for name, _ in members]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError("File names used more than once in the archive: " + ", ".join(duplicates))
+    return members
+
+
+# watermark token of a delta export: the url-safe base64 of the UTC timestamp in ISO 8601
+def watermark_token(watermark):
+    if watermark is None:
+        return None
+    if watermark.tzinfo is None:
+        watermark = watermark.replace(tzinfo=timezone.utc)
+    return base64.urlsafe_b64encode(watermark.astimezone(timezone.utc).isoformat().encode()).decode().rstrip('=')
+
+
+# watermark of a delta export from an ISO 8601 timestamp or a watermark token(UTC when no offset is given),
+# None if the value is neither
+def parse_watermark(value):
+    try:
+        watermark = datetime.fromisoformat(value)
+    except ValueError:
+        try:
+            watermark = datetime.fromisoformat(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode())
+        except (ValueError, UnicodeDecodeError):
+            return None
+    if watermark.tzinfo is None:
+        watermark = watermark.replace(tzinfo=timezone.utc)
+    return watermark.astimezone(timezone.utc)
+
+
 # create api key with salt
 def create_api_key(length: int = 12):
     salt = string.ascii_letters + string.digits + string.punctuation
     return ''.join(secrets.choice(salt) for _ in range(length))
-
-
-def calculate_md5(file):
-    file_hash = hashlib.md4()
-    while chunk := file.read(8192):
-        file_hash.update(chunk)
-    return file_hash.hexdigest()
-
@@ -0,0 +1,183 @@
+"""
+synthetic catalogue for the benchmarks: batches, multimedias(with segmentation children), extended image metadata
+and image quality metadata, generated from a seed so every run sees the same data
+
+the rows are written to the configured database([database] url in config.ini, use a local database),
+all batch ark ids start with "bench" so the catalogue can be dropped again
+
+run from the repository root: python -m benchmarks.catalogue --rows 100000
+                              python -m benchmarks.catalogue --drop
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, select
+
+from app import migrate, model_text
+from app.database import engine
+
+SIZES = {'10k': 10000, '100k': 100000, '1m': 1000000}
+
+BENCH_PREFIX = 'bench'
+BENCH_PERSON = 'benchperson'
+BENCH_API_KEY = 'benchmark-api-key'
+
+MULTIMEDIAS_PER_BATCH = 1000
+# one multimedia in CHILD_EVERY is a segmentation child of the multimedia before it
+CHILD_EVERY = 10
+# one multimedia in QUALITY_EVERY has image quality metadata
+QUALITY_EVERY = 3
+
+TAXA = [
+    ('Cyprinidae', 'Notropis', 'Notropis atherinoides'), ('Cyprinidae', 'Notropis', 'Notropis hudsonius'),
+    ('Cyprinidae', 'Cyprinella', 'Cyprinella lutrensis'), ('Cyprinidae', 'Pimephales', 'Pimephales notatus'),
+    ('Centrarchidae', 'Lepomis', 'Lepomis macrochirus'), ('Centrarchidae', 'Lepomis', 'Lepomis cyanellus'),
+    ('Centrarchidae', 'Micropterus', 'Micropterus salmoides'), ('Percidae', 'Etheostoma', 'Etheostoma caeruleum'),
+    ('Percidae', 'Percina', 'Percina caprodes'), ('Ictaluridae', 'Noturus', 'Noturus flavus'),
+    ('Catostomidae', 'Moxostoma', 'Moxostoma erythrurum'), ('Fundulidae', 'Fundulus', 'Fundulus notatus'),
+]
+INSTITUTIONS = ['INHS', 'FMNH', 'OSUM', 'UWZM', 'JFBM', 'TUBRI']
+DATASETS = ['GLIN', 'iDigBio', 'GBIF', 'Morphbank']
+START_DATE = datetime(2022, 1, 1)
+
+
+def multimedia_ark(i):
+    return 'bm%08d' % i
+
+
+def batch_ark(i):
+    return '%s%05d' % (BENCH_PREFIX, i // MULTIMEDIAS_PER_BATCH)
+
+
+def is_child(i):
+    return i % CHILD_EVERY == CHILD_EVERY - 1
+
+
+def has_quality(i):
+    return i % QUALITY_EVERY == 0 and not is_child(i)
+
+
+# the rows of multimedias [start, stop): (batches, multimedias, extended metadata, quality metadata)
+def catalogue_rows(start, stop, seed=42):
+    batches, multimedias, extended, quality = [], [], [], []
+    for i in range(start, stop):
+        rng = random.Random(seed * 1000003 + i)
+        if i % MULTIMEDIAS_PER_BATCH == 0:
+            institution = INSTITUTIONS[(i // MULTIMEDIAS_PER_BATCH) % len(INSTITUTIONS)]
+            batches.append({
+                'ark_id': batch_ark(i), 'batch_name': 'benchmark batch %d' % (i // MULTIMEDIAS_PER_BATCH),
+                'institution_code': institution, 'pipeline': 'segmentation', 'dataset_name': 'fish',
+                'bibliographic_citation': 'Fish-AIR benchmark batch %d' % (i // MULTIMEDIAS_PER_BATCH),
+                'creator_user_id': BENCH_PERSON,
+                'create_date': START_DATE, 'modify_date': START_DATE + timedelta(minutes=i // MULTIMEDIAS_PER_BATCH),
+            })
+        family, genus, scientific_name = TAXA[rng.randrange(len(TAXA))]
+        created = START_DATE + timedelta(seconds=i * 30)
+        child = is_child(i)
+        ark_id = multimedia_ark(i)
+        multimedias.append({
+            'ark_id': ark_id, 'parent_ark_id': multimedia_ark(i - 1) if child else None,
+            'batch_ark_id': batch_ark(i), 'batch_id': 'benchmark batch %d' % (i // MULTIMEDIAS_PER_BATCH),
+            'path': 'https://fishair.org/hdr-share/ftp/ark/89609/%s/%s.%s' % (
+                batch_ark(i), ark_id, 'png' if child else 'jpg'),
+            'filename_as_delivered': '%s_%d%s' % (genus.upper(), i, '_mask.png' if child else '.jpg'),
+            'format': 'png' if child else 'jpg', 'license': 'CC BY-NC',
+            'source': INSTITUTIONS[rng.randrange(len(INSTITUTIONS))],
+            'owner_institution_code': INSTITUTIONS[rng.randrange(len(INSTITUTIONS))],
+            'scientific_name': scientific_name, 'genus': genus, 'family': family,
+            'dataset': 'segmentation' if child else DATASETS[rng.randrange(len(DATASETS))],
+            'create_date': created, 'modify_date': created,
+        })
+        width = rng.randrange(800, 6000)
+        extended.append({
+            'ext_image_metadata_id': 'be%08d' % i, 'ark_id': ark_id, 'size': width * 900 + rng.randrange(1000),
+            'width': width, 'height': width * 2 // 3, 'license': 'CC BY-NC', 'publisher': 'Fish-AIR',
+            'owner_institution_code': 'TUBRI', 'resolution': '300x300 dpi',
+            'create_date': created, 'metadata_date': created,
+        })
+        if has_quality(i):
+            quality.append({
+                'iq_metadata_id': 'bq%08d' % i, 'ark_id': ark_id, 'specimen_quantity': 1,
+                'contains_scalebar': rng.random() < 0.8, 'contains_colorbar': rng.random() < 0.3,
+                'contains_barcode': rng.random() < 0.2, 'contains_label': rng.random() < 0.9,
+                'brightness': rng.choice(['normal', 'dark', 'bright']), 'color_issue': 'none',
+                'parts_folded': False, 'parts_missing': rng.random() < 0.1, 'parts_overlapping': False,
+                'all_parts_visible': True, 'specimen_angle': 'straight', 'specimen_view': 'left',
+                'specimen_curved': 'straight', 'uniform_background': True, 'on_focus': rng.random() < 0.95,
+                'quality': rng.randrange(1, 6), 'accession_number_validity': True,
+                'data_capture_method': 'scanner', 'license': 'CC BY-NC', 'publisher': 'Fish-AIR',
+                'owner_institution_code': 'TUBRI',
+            })
+    return batches, multimedias, extended, quality
+
+
+# number of benchmark multimedias in the database
+def catalogue_size(bind=engine):
+    with bind.connect() as connection:
+        return connection.execute(select(func.count()).select_from(model_text.Multimeida).where(
+            model_text.Multimeida.batch_ark_id.like(BENCH_PREFIX + '%'))).scalar()
+
+
+def drop(bind=engine):
+    multimedia_ids = select(model_text.Multimeida.ark_id).where(
+        model_text.Multimeida.batch_ark_id.like(BENCH_PREFIX + '%'))
+    with bind.begin() as connection:
+        connection.execute(delete(model_text.ImageQualityMetadatum).where(
+            model_text.ImageQualityMetadatum.ark_id.in_(multimedia_ids)))
+        connection.execute(delete(model_text.ExtendedImageMetadatum).where(
+            model_text.ExtendedImageMetadatum.ark_id.in_(multimedia_ids)))
+        # children first, parent_ark_id references the parent row
+        connection.execute(delete(model_text.Multimeida).where(
+            model_text.Multimeida.batch_ark_id.like(BENCH_PREFIX + '%'),
+            model_text.Multimeida.parent_ark_id.isnot(None)))
+        connection.execute(delete(model_text.Multimeida).where(
+            model_text.Multimeida.batch_ark_id.like(BENCH_PREFIX + '%')))
+        connection.execute(delete(model_text.Batch).where(model_text.Batch.ark_id.like(BENCH_PREFIX + '%')))
+        connection.execute(delete(model_text.Person).where(model_text.Person.people_id == BENCH_PERSON))
+
+
+# (re)create the benchmark catalogue with `rows` multimedias, inserted chunk_size multimedias per transaction
+def generate(rows, seed=42, chunk_size=10000, bind=engine, progress=None):
+    migrate.upgrade(bind, log=lambda message: None)
+    drop(bind)
+    with bind.begin() as connection:
+        connection.execute(insert(model_text.Person), [{
+            'people_id': BENCH_PERSON, 'first_name': 'Benchmark', 'last_name': 'User',
+            'email': 'benchmark@localhost', 'purpose': 'benchmark', 'api_key': BENCH_API_KEY}])
+    for start in range(0, rows, chunk_size):
+        batches, multimedias, extended, quality = catalogue_rows(start, min(start + chunk_size, rows), seed)
+        with bind.begin() as connection:
+            if batches:
+                connection.execute(insert(model_text.Batch), batches)
+            connection.execute(insert(model_text.Multimeida), multimedias)
+            connection.execute(insert(model_text.ExtendedImageMetadatum), extended)
+            if quality:
+                connection.execute(insert(model_text.ImageQualityMetadatum), quality)
+        if progress is not None:
+            progress(min(start + chunk_size, rows))
+
+
+def parse_rows(value):
+    return SIZES.get(value.lower()) or int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=parse_rows, default=SIZES['10k'], help='multimedias: 10k, 100k, 1m or a number')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--drop', action='store_true', help='remove the benchmark catalogue')
+    args = parser.parse_args()
+
+    if args.drop:
+        drop()
+        print('benchmark catalogue dropped')
+        return
+    start = time.perf_counter()
+    generate(args.rows, args.seed, progress=lambda done: print('%10d / %d multimedias' % (done, args.rows)))
+    print('%d multimedias in %.1f s' % (args.rows, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
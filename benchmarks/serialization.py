@@ -0,0 +1,83 @@
+"""
+serialization benchmark: response_model validation + JSONResponse against the compiled serializers
+
+run from the repository root: python -m benchmarks.serialization --rows 1000 --repeat 5
+"""
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+
+from fastapi.encoders import jsonable_encoder
+
+from app import model_text, schemas, serializers
+
+
+# transient multimedias with extended/quality metadata, a batch and one child each
+def sample_multimedias(rows):
+    batch = model_text.Batch(ark_id='batbench', batch_name='benchmark batch', institution_code='TUBRI',
+                             dataset_name='GLIN', bibliographic_citation='Fish-AIR benchmark')
+    created = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    multimedias = []
+    for i in range(rows):
+        multimedia = model_text.Multimeida(
+            ark_id='m%07d' % i, batch_ark_id=batch.ark_id, batch_id=batch.batch_name,
+            path='https://fishair.org/hdr-share/ftp/ark/89609/batbench/m%07d.jpg' % i,
+            filename_as_delivered='INHS_FISH_%d.jpg' % i, format='jpg', license='CC BY-NC', source='INHS',
+            owner_institution_code='INHS', scientific_name='Notropis atherinoides', genus='Notropis',
+            family='Cyprinidae', dataset='GLIN')
+        multimedia.batch = batch
+        multimedia.extended_metadata = [model_text.ExtendedImageMetadatum(
+            ext_image_metadata_id='e%07d' % i, size=2048000 + i, width=4000, height=3000, license='CC BY-NC',
+            publisher='Fish-Air', owner_institution_code='TUBRI', resolution='300x300 dpi')]
+        multimedia.quality_metadata = [model_text.ImageQualityMetadatum(
+            iq_metadata_id='q%07d' % i, specimen_quantity=1, contains_scalebar=True, contains_colorbar=False,
+            contains_barcode=False, contains_label=True, brightness='normal', color_issue='none',
+            parts_folded=False, parts_missing=False, parts_overlapping=False, all_parts_visible=True,
+            specimen_angle='straight', specimen_view='left', specimen_curved='straight', uniform_background=True,
+            on_focus=True, quality=3, accession_number_validity=True, data_capture_method='scanner',
+            license='CC BY-NC', publisher='Fish-Air', owner_institution_code='TUBRI',
+            create_date=created + timedelta(seconds=i), metadata_date=created)]
+        multimedia.children = [model_text.Multimeida(
+            ark_id='c%07d' % i, parent_ark_id=multimedia.ark_id, batch_id=batch.batch_name,
+            path='https://fishair.org/hdr-share/ftp/ark/89609/batbench/c%07d.png' % i,
+            filename_as_delivered='INHS_FISH_%d_mask.png' % i, format='png', dataset='segmentation')]
+        multimedias.append(multimedia)
+    return multimedias
+
+
+def schema_dumps(multimedias):
+    return serializers.render(jsonable_encoder([schemas.MultimediaChild.from_orm(row) for row in multimedias]))
+
+
+def compiled_dumps(multimedias):
+    return serializers.dumps(schemas.MultimediaChild, multimedias)
+
+
+def best_time(func, multimedias, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(multimedias)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    multimedias = sample_multimedias(args.rows)
+    if schema_dumps(multimedias) != compiled_dumps(multimedias):
+        raise SystemExit('compiled serializer output differs from the schema output')
+    schema_time = best_time(schema_dumps, multimedias, args.repeat)
+    compiled_time = best_time(compiled_dumps, multimedias, args.repeat)
+    print('rows: %d, encoder: %s' % (args.rows, 'orjson' if serializers.orjson is not None else 'json'))
+    print('schema   : %8.2f ms  %10.0f rows/s' % (schema_time * 1000, args.rows / schema_time))
+    print('compiled : %8.2f ms  %10.0f rows/s' % (compiled_time * 1000, args.rows / compiled_time))
+    print('speedup  : %8.1fx' % (schema_time / compiled_time))
+
+
+if __name__ == '__main__':
+    main()
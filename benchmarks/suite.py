@@ -0,0 +1,369 @@
+"""
+benchmark suite: throughput, latency percentiles and peak memory of the read, export and upload paths
+on the synthetic catalogue, compared against a stored baseline
+
+  get_multimedias     crud.get_multimedias with a genus filter, `--page` multimedias per call
+  zip_export          crud.export_multimedias + zipfile_builder, the archive is read to the end(csv and parquet)
+  multimedia_arkid    GET /multimedia/{ARKID}
+  image_upload        POST /image/ with generated jpeg images
+
+run from the repository root against a local database([database] url in config.ini):
+  python -m benchmarks.suite --rows 10k --generate      create the catalogue first, then run
+  python -m benchmarks.suite --rows 10k                 compare with benchmarks/baseline.json
+  python -m benchmarks.suite --rows 10k --save-baseline store the results as the new baseline
+  python -m benchmarks.suite --output main.json         on the main branch, then on a change:
+  python -m benchmarks.suite --compare main.json        compare with that run on the same machine
+the exit status is 1 when a case is slower or uses more memory than the baseline allows(--tolerance)
+
+benchmarks/baseline.json holds the reference of the default arguments on the 10k catalogue with sqlite, the
+machine it was measured on is stored with it, on other machines compare two runs with --output/--compare
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from PIL import Image
+from sqlalchemy import delete
+
+from app import crud, migrate, model_text
+import app.config as config
+from app.database import SessionLocal
+from app.utils import zipfile_builder
+from benchmarks import catalogue
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# compared with the baseline: (result key, True if higher is better)
+COMPARED = [('throughput', True), ('p95_ms', False), ('peak_mb', False)]
+
+
+# nearest-rank percentile of sorted values
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, math.ceil(pct / 100.0 * len(values)) - 1))
+    return values[index]
+
+
+class Case:
+    """
+    one benchmark: setup() once, run() per operation returning the number of items it processed(rows,
+    requests), teardown() at the end, `unit` names the items of the throughput
+    """
+    name = None
+    unit = 'rows'
+
+    def setup(self):
+        pass
+
+    def run(self):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+
+class GetMultimedias(Case):
+    name = 'get_multimedias'
+
+    def __init__(self, page):
+        self.page = page
+        self.genera = sorted({genus for _, genus, _ in catalogue.TAXA})
+        self.calls = 0
+
+    def run(self):
+        genus = self.genera[self.calls % len(self.genera)]
+        self.calls += 1
+        db = SessionLocal()
+        try:
+            multimedias, _ = crud.get_multimedias(db, zipfile=True, limit=self.page, genus=genus)
+            return len(multimedias)
+        finally:
+            db.close()
+
+
+class ZipExport(Case):
+    unit = 'rows'
+
+    def __init__(self, limit, export_format='csv'):
+        self.limit = limit
+        self.export_format = export_format
+        self.name = 'zip_export' if export_format == 'csv' else 'zip_export_' + export_format
+        self.bytes = 0
+
+    def run(self):
+        db = SessionLocal()
+        try:
+            results, batch_results = crud.export_multimedias(db, limit=self.limit)
+            zf = zipfile_builder(results, batch_results, {'genus': None, 'family': None, 'dataset': None},
+                                 self.export_format, crud.EXPORT_COLUMNS)
+            size = 0
+            for chunk in zf:
+                size += len(chunk)
+            self.bytes = size
+            return crud.count_multimedias(db, limit=self.limit)
+        finally:
+            db.close()
+
+
+class MultimediaArkid(Case):
+    name = 'multimedia_arkid'
+    unit = 'requests'
+
+    def __init__(self, client, rows, seed):
+        self.client = client
+        rng = random.Random(seed)
+        # multimedias without quality metadata in their hierarchy: the quality dates(time columns) do not
+        # pass the IQ schema
+        self.ark_ids = [catalogue.multimedia_ark(i) for i in (rng.randrange(rows) for _ in range(1000))
+                        if not catalogue.has_quality(i) and not catalogue.is_child(i)]
+        self.calls = 0
+
+    def run(self):
+        ark_id = self.ark_ids[self.calls % len(self.ark_ids)]
+        self.calls += 1
+        response = self.client.get('/multimedia/' + ark_id)
+        if response.status_code != 200:
+            raise RuntimeError('GET /multimedia/%s: %d %s' % (ark_id, response.status_code, response.text[:200]))
+        return 1
+
+
+class ImageUpload(Case):
+    name = 'image_upload'
+    unit = 'requests'
+
+    def __init__(self, client, seed):
+        self.client = client
+        self.rng = random.Random(seed)
+        self.ark_ids = []
+
+    # a jpeg with different content every time, so no upload is a duplicate of another
+    def image(self):
+        buffer = io.BytesIO()
+        color = tuple(self.rng.randrange(256) for _ in range(3))
+        Image.new('RGB', (640, 480), color).save(buffer, 'JPEG', quality=90)
+        return buffer.getvalue()
+
+    def run(self):
+        response = self.client.post('/image/', headers={'x-api-key': catalogue.BENCH_API_KEY}, data={
+            'batchARKID': catalogue.batch_ark(0), 'scientificName': 'Notropis atherinoides', 'genus': 'Notropis',
+            'family': 'Cyprinidae', 'onDuplicate': 'link',
+        }, files={'file': ('upload_%d.jpg' % len(self.ark_ids), self.image(), 'image/jpeg')})
+        if response.status_code != 200:
+            raise RuntimeError('POST /image/: %d %s' % (response.status_code, response.text[:200]))
+        self.ark_ids.append(response.json()['ark_id'])
+        return 1
+
+    # uploaded multimedias are removed, the catalogue stays the same between runs
+    def teardown(self):
+        db = SessionLocal()
+        try:
+            db.execute(delete(model_text.ExtendedImageMetadatum).where(
+                model_text.ExtendedImageMetadatum.ark_id.in_(self.ark_ids)))
+            db.execute(delete(model_text.Multimeida).where(model_text.Multimeida.ark_id.in_(self.ark_ids)))
+            db.commit()
+        finally:
+            db.close()
+
+
+# time `operations` runs of a case, then one more run under tracemalloc for the peak memory
+def measure(case, operations, warmup=1):
+    case.setup()
+    try:
+        for _ in range(warmup):
+            case.run()
+        latencies = []
+        items = 0
+        start = time.perf_counter()
+        for _ in range(operations):
+            operation_start = time.perf_counter()
+            items += case.run()
+            latencies.append(time.perf_counter() - operation_start)
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        try:
+            case.run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    finally:
+        case.teardown()
+    latencies.sort()
+    result = {
+        'operations': operations,
+        'unit': case.unit,
+        'throughput': round(items / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'peak_mb': round(peak / 1048576, 2),
+    }
+    if isinstance(case, ZipExport):
+        result['archive_mb'] = round(case.bytes / 1048576, 2)
+    return result
+
+
+# regressions against the baseline of the same catalogue size: [(case, key, baseline, current)]
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        for key, higher_is_better in COMPARED:
+            if key not in reference:
+                continue
+            if higher_is_better:
+                regressed = result[key] < reference[key] * (1 - tolerance)
+            else:
+                regressed = result[key] > reference[key] * (1 + tolerance)
+            if regressed:
+                regressions.append((name, key, reference[key], result[key]))
+    return regressions
+
+
+# where the results were measured, stored with a baseline
+def machine_info():
+    from app.database import engine
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'database': '%s %s' % (engine.dialect.name, '.'.join(map(str, engine.dialect.server_version_info or ()))),
+    }
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, baselines):
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def print_results(results, baseline):
+    print('%-20s %12s %-9s %10s %10s %10s %9s   baseline throughput/p95/peak' % (
+        'case', 'throughput', '', 'p50 ms', 'p95 ms', 'p99 ms', 'peak MB'))
+    for name, result in results.items():
+        reference = baseline.get(name)
+        reference_text = '' if reference is None else '%s / %s / %s' % (
+            reference.get('throughput'), reference.get('p95_ms'), reference.get('peak_mb'))
+        print('%-20s %12.1f %-9s %10.2f %10.2f %10.2f %9.2f   %s' % (
+            name, result['throughput'], result['unit'] + '/s', result['p50_ms'], result['p95_ms'],
+            result['p99_ms'], result['peak_mb'], reference_text))
+
+
+# export templates(meta.xml, rdf.owl, metadata.xml) of the configured ZIPFILES_PATH, placeholders when the
+# path does not exist on this machine
+def use_zipfile_templates(directory):
+    if os.path.exists(os.path.join(config.ZIPFILES_PATH, 'metadata.xml')):
+        return
+    for name in ('meta.xml', 'rdf.owl', 'metadata.xml'):
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write('<benchmark dataset="{{ dataset_ark_id }}"/>\n' if name == 'metadata.xml' else '<benchmark/>\n')
+    config.ZIPFILES_PATH = directory + os.sep
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=catalogue.parse_rows, default=catalogue.SIZES['10k'],
+                        help='catalogue size: 10k, 100k, 1m or a number')
+    parser.add_argument('--generate', action='store_true', help='(re)create the catalogue before the run')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--cases', default='get_multimedias,zip_export,zip_export_parquet,multimedia_arkid,'
+                                           'image_upload', help='comma separated cases to run')
+    parser.add_argument('--repeat', type=int, default=20, help='operations per read case')
+    parser.add_argument('--export-repeat', type=int, default=3, help='operations per export case')
+    parser.add_argument('--requests', type=int, default=200, help='requests per HTTP case')
+    parser.add_argument('--page', type=int, default=1000, help='multimedias per get_multimedias call')
+    parser.add_argument('--export-limit', type=int, default=-1, help='multimedias per export, -1 for all')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--compare', help='compare with the results of another run(--output) instead of the '
+                                          'baseline, fails when the file has no results for this catalogue size')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative regression against the baseline(0.2 = 20%%)')
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args()
+
+    # the schema of the checked out code, the catalogue may have been generated by an older one
+    migrate.upgrade(log=lambda message: None)
+    if args.generate or catalogue.catalogue_size() == 0:
+        print('generating %d multimedias' % args.rows)
+        catalogue.generate(args.rows, args.seed)
+    rows = catalogue.catalogue_size()
+    if rows != args.rows:
+        print('note: the catalogue has %d multimedias, run with --generate for %d' % (rows, args.rows))
+
+    work_dir = tempfile.mkdtemp(prefix='bgnn-benchmark-')
+    config.MULTIMEDIA_PATH = work_dir + os.sep
+    use_zipfile_templates(work_dir)
+    from fastapi.testclient import TestClient
+    from app import main as app_main, parquet
+
+    selected = [name.strip() for name in args.cases.split(',') if name.strip()]
+    results = {}
+    try:
+        with TestClient(app_main.app) as client:
+            cases = {
+                'get_multimedias': (GetMultimedias(args.page), args.repeat),
+                'zip_export': (ZipExport(args.export_limit), args.export_repeat),
+                'multimedia_arkid': (MultimediaArkid(client, rows, args.seed), args.requests),
+                'image_upload': (ImageUpload(client, args.seed), max(1, args.requests // 4)),
+            }
+            if parquet.pyarrow is not None:
+                cases['zip_export_parquet'] = (ZipExport(args.export_limit, 'parquet'), args.export_repeat)
+            for name in selected:
+                if name not in cases:
+                    print('skipped %s: unknown case or missing dependency' % name)
+                    continue
+                case, operations = cases[name]
+                results[name] = measure(case, operations)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    machine = machine_info()
+    baselines = load_baseline(args.compare or args.baseline)
+    baseline = baselines.get(str(rows), {})
+    print('catalogue: %d multimedias' % rows)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({str(rows): dict(results, machine=machine)}, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        baselines = load_baseline(args.baseline)
+        baselines[str(rows)] = dict(results, machine=machine)
+        save_baseline(args.baseline, baselines)
+        print('baseline saved to %s' % args.baseline)
+        return
+    if not baseline:
+        if args.compare:
+            raise SystemExit('no results for %d multimedias in %s' % (rows, args.compare))
+        print('no baseline for %d multimedias, store one with --save-baseline' % rows)
+        return
+    if baseline.get('machine') != machine:
+        print('note: the baseline was measured on another machine: %s' % baseline.get('machine'))
+    regressions = compare(results, baseline, args.tolerance)
+    for name, key, reference, current in regressions:
+        print('REGRESSION %s %s: %s -> %s' % (name, key, reference, current))
+    if regressions:
+        raise SystemExit(1)
+    print('no regressions(tolerance %d%%)' % round(args.tolerance * 100))
+
+
+if __name__ == '__main__':
+    main()